@@ -28,6 +28,7 @@
 # ./runginan.py -d --config  ./runginan.yaml 60589
 
 import argparse
+import copy
 import glob
 import os
 import re
@@ -122,6 +123,171 @@ def ScrubDir(theDir):
 			if os.path.isfile(f):
 				os.unlink(f)
 		
+# ------------------------------------------
+def MakeGinanCfg():
+	# Returns the Ginan configuration, made from the template for the current run directory
+	gCfg = EditCfg(copy.deepcopy(gCfgTemplate)) # the template is edited in place
+	gCfg['receiver_options'][rnxStation4Letter] = {}
+	gCfg['receiver_options'][rnxStation4Letter]['receiver_type']    = cfg['receiver_options']['receiver_type']
+	gCfg['receiver_options'][rnxStation4Letter]['antenna_type']     = cfg['receiver_options']['antenna_type']
+	gCfg['receiver_options'][rnxStation4Letter]['apriori_position'] = cfg['receiver_options']['apriori_position']
+	return gCfg
+
+# ------------------------------------------
+def PrepareDay(mjd,gCfg):
+	# Sets up runDir for processing one day and writes the Ginan configuration there
+	# Returns the path of the configuration and the name of the clock file, or None if there are no observations
+	# Raises an exception if the day can't be prepared
+	
+	(yyyy,doy,mon) = ottp.MJDtoYYYYDOY(mjd)
+	yy = yyyy % 100
+	
+	ottp.Debug(f'Processing MJD={mjd} yyyy={yyyy} doy={doy}')
+	
+	# Do any necessary preprocessing of the station observation files, including decompression
+	# First, find the file
+	
+	(baseObsPath, compressionExt) = rinex.FindObservationFile(srcDir,rnxStation,yyyy,doy,3,True)
+	obsPath = baseObsPath + compressionExt # note that compression extensions are .gz and .Z, not .crx 
+	obsBaseName = os.path.basename(obsPath)
+	
+	# editrnxobs.py will decompress for us but then helpfully (and unnecessarily) recompress it
+	# So give it a decompressed file, which it will leave as is
+	#
+	# Copy the RINEX file to the temporary directory
+	# This is because we might be using files from another user's directory where
+	# we don't have permission to decompress in place 
+	# (and this use case is not supported by editrnxobs.py at present either)
+		
+	dstDir = gCfg['inputs']['gnss_observations']['gnss_observations_root']
+	if not os.path.isdir(dstDir):
+		os.mkdir(dstDir)
+		
+	shutil.copy(obsPath,tmpDir)
+	obsDecompressedPath,algo = rinex.Decompress(os.path.join(tmpDir,obsBaseName)) # this will be deleted so no need to save details for recompression
+	obsDecompressedBaseName = os.path.basename(obsDecompressedPath)
+	
+	ottp.Debug('Running ' + editRnxObs)
+	try:
+		cmdargs = [editRnxObs,'--tmpdir',tmpDir,'--excludegnss',exclusions,'--output',dstDir,obsDecompressedPath]
+		# print(cmdargs) # FIXME useful when debugging
+		x = subprocess.check_output(cmdargs) 
+	except Exception as e:
+		raise RuntimeError('Failed to run {} ({})'.format(editRnxObs,e))
+	
+	ginanInputRINEX = os.path.join(dstDir,obsDecompressedBaseName)
+	if not(os.path.exists(ginanInputRINEX)): # hmmm no output
+		ottp.Debug(f'Expected {ginanInputRINEX} - not found!')
+		return None # not fatal
+	
+	# Customize the Ginan config after finding the file because we need the decompressed base name
+	# and write it out
+	gCfg['inputs']['gnss_observations']['rnx_inputs'] = [obsDecompressedBaseName] # pea grumbles if this is not a list, so give it a list
+	
+	for sd in satData:
+		dstDir = os.path.dirname(gCfg['inputs']['satellite_data'][sd[0]][0]) # destination directory
+		fileName = MJDtoIGSProductName(mjd,sd[1])
+		gCfg['inputs']['satellite_data'][sd[0]] = [os.path.join(dstDir,fileName)]
+		# lazy find
+		files = glob.glob(os.path.join(satDataSrcDir,fileName)+'*')
+		if files:
+			shutil.copy(files[0],dstDir)
+			rinex.Decompress(os.path.join(dstDir,os.path.basename(files[0])))
+		else:
+			pass # FIXME what do we do
+
+	clkFile = clkFileTemplate
+	if 'YYDDD' in clkFile:
+		clkFile = clkFile.replace('YYDDD',f'{yy:02d}{doy:03d}',1)
+		gCfg['outputs']['clocks']['filename']  =  clkFile
+	elif 'DDD0.YY' in clkFile:
+		clkFile = clkFile.replace('DDD0.YY',f'{doy:03d}{yy:02d}',1)
+		gCfg['outputs']['clocks']['filename']  =  clkFile
+	
+	# FIXME unlink this always ?
+	gCfgOut = os.path.join(runDir,'pppclk.yaml')
+	try:
+		fout = open(gCfgOut, 'w')
+	except OSError as e:
+		raise RuntimeError('Unable to open {} ({})'.format(gCfgOut,e))
+		
+	yaml.safe_dump(gCfg, fout, sort_keys = False) # We preserve the input order. Note that comments are stripped
+	fout.close()
+	
+	return (gCfgOut,clkFile)
+
+# ------------------------------------------
+def StartPea(mjd,gCfg,gCfgOut,clkFile):
+	# Starts pea running on one day, without waiting for it
+	# Returns the job
+	ottp.Debug(f'Running pea for MJD {mjd}')
+	
+	if cfg['pea']['options']:
+		userArgs = cfg['pea']['options'].split()
+	else:
+		userArgs = []
+		
+	cmdargs = [peaExec,'-y',gCfgOut] + userArgs
+	try:
+		with open(os.path.join(runDir,'pea.log'),'w') as flog: # so that output from simultaneous jobs is not mixed up
+			proc = subprocess.Popen(cmdargs,stdout=flog,stderr=subprocess.STDOUT)
+	except Exception as e:
+		print(e)
+		ottp.ErrorExit('Failed to run ' + peaExec)
+	return {'mjd':mjd,'process':proc,'cfg':gCfg,'clk':clkFile,'dir':runDir,'start':time.time()}
+
+# ------------------------------------------
+def FinishPea(job):
+	# Collects the output of a finished pea job, namely the smoothed clock file
+	# Returns True if all went well
+	ottp.Debug('MJD {} job run time = {:g} s'.format(job['mjd'],time.time()-job['start']))
+	if job['process'].returncode != 0:
+		print('Failed to run {} for MJD {} (exit status {})'.format(peaExec,job['mjd'],job['process'].returncode))
+		return False
+	
+	# Ginan appears to put _smoothed before the extension
+	gCfg = job['cfg']
+	base,ext = os.path.splitext(job['clk'])
+	clkPath = os.path.join(gCfg['outputs']['clocks']['directory'],f'{base}_smoothed{ext}')
+	try:
+		shutil.copy(clkPath,os.path.join(outputClockDir,job['clk']))
+	except OSError as e:
+		print('Failed to collect the CLK file for MJD {} ({})'.format(job['mjd'],e))
+		return False
+	ottp.Debug(f'CLK file in {outputClockDir}/{job["clk"]}')
+	if nJobs > 1 and not(args.debug): # the day's run directory is no longer needed
+		ottp.Debug('Removing ' + job['dir'])
+		shutil.rmtree(job['dir'],ignore_errors=True)
+	return True
+
+# ------------------------------------------
+def WaitForJobs(jobs,maxJobs):
+	# Waits until fewer than maxJobs jobs are running, collecting the output of the jobs that have finished
+	# Returns the MJDs of jobs that failed
+	failures = []
+	while len(jobs) >= maxJobs and jobs:
+		for job in list(jobs):
+			if job['process'].poll() is None:
+				continue
+			jobs.remove(job)
+			if not(FinishPea(job)):
+				failures.append(job['mjd'])
+		if len(jobs) == 1: # no need to poll
+			jobs[0]['process'].wait()
+		elif len(jobs) >= maxJobs:
+			time.sleep(1)
+	return failures
+
+# ------------------------------------------
+def StopJobs(jobs):
+	# Terminates the jobs that are still running, so that they aren't orphaned when we exit
+	for job in jobs:
+		if job['process'].poll() is None:
+			print('Stopping {} for MJD {}'.format(peaExec,job['mjd']))
+			job['process'].terminate()
+	for job in jobs:
+		job['process'].wait()
+
 # --------------------------------------------------------------------------------------------------------
 
 
@@ -142,12 +308,16 @@ exclusions = 'CREIJS' # GNSS to remove from RINEX before processing
 parser = argparse.ArgumentParser(description='')
 
 examples =  'Usage examples\n'
+examples += '1. Reprocess 30 days, 8 days at a time\n'
+examples += 'runginan.py --daily --jobs 8 60570 60599\n'
 
 parser = argparse.ArgumentParser(description='Generate a station clock solution using Ginan PPP',
 	formatter_class=argparse.RawDescriptionHelpFormatter,epilog=examples)
 
 parser.add_argument('mjd',nargs = '*',help='first MJD [last MJD]')
 parser.add_argument('--daily',help='generate daily files',action='store_true')
+parser.add_argument('--jobs','-j',help='with --daily, number of days to process at the same time (default 1)',type=int,default=1)
+parser.add_argument('--threads',help='with --jobs, total number of threads that the jobs can use (default is the number of CPUs)',type=int,default=0)
 parser.add_argument('--config','-c',help='use an alternate configuration file',default=configFile)
 parser.add_argument('--debug','-d',help='debug (to stderr)',action='store_true')
 parser.add_argument('--version','-v',action='version',version = os.path.basename(sys.argv[0])+ ' ' + VERSION + '\n' + 'Written by ' + AUTHORS)
@@ -174,14 +344,23 @@ fin.close()
 if 'exec' in cfg['pea']:
 	peaExec = cfg['pea']['exec']
 	
-if 'openmpthread' in cfg['pea']:
-	nthreads = cfg['pea']['openmpthreads']
+if 'openmpthreads' in cfg['pea']:
+	nthreads = str(cfg['pea']['openmpthreads'])
 	if not(nthreads == '0'):
 			os.environ['OMP_NUM_THREADS'] = nthreads
 else:
 	os.environ['OMP_NUM_THREADS'] = '1' # works better for one station
 	nthreads = '1'
 	
+nJobs = max(1,args.jobs)
+if nJobs > 1: # share out the threads
+	threadBudget = args.threads or os.cpu_count()
+	if nthreads == '0': # auto select, so give each job an equal share
+		nthreads = str(max(1,threadBudget // nJobs))
+	nJobs = max(1,min(nJobs,threadBudget // int(nthreads)))
+	os.environ['OMP_NUM_THREADS'] = nthreads
+	ottp.Debug(f'Running {nJobs} jobs at a time, with a budget of {threadBudget} threads')
+	
 ottp.Debug(f'OpenMP threads = {nthreads} [0==auto select]')
 
 if 'root' in cfg['pea']:
@@ -195,6 +374,7 @@ cfg = EditCfg(cfg) # make substitutions
 runDir = cfg['pea']['run_dir']
 if not os.path.isdir(runDir):
 	os.mkdir(runDir)
+baseRunDir = runDir # with --jobs, each day has its own run directory in here
 tmpDir = os.path.join(runDir,'tmp') # give each run its own temporary directory
 if not os.path.isdir(tmpDir):
 	os.mkdir(tmpDir)
@@ -239,15 +419,10 @@ try:
 except:
 	ottp.ErrorExit('Unable to open ' + pppTemplate)
 	
-gCfg = yaml.safe_load(fin) # only need to load the template once
+gCfgTemplate = yaml.safe_load(fin) # only need to load the template once
 fin.close()
 
-gCfg = EditCfg(gCfg)
-
-gCfg['receiver_options'][rnxStation4Letter] = {}
-gCfg['receiver_options'][rnxStation4Letter]['receiver_type']    = cfg['receiver_options']['receiver_type']
-gCfg['receiver_options'][rnxStation4Letter]['antenna_type']     = cfg['receiver_options']['antenna_type']
-gCfg['receiver_options'][rnxStation4Letter]['apriori_position'] = cfg['receiver_options']['apriori_position']
+gCfg = MakeGinanCfg()
 	
 dstDir = gCfg['inputs']['gnss_observations']['gnss_observations_root']
 if not os.path.isdir(dstDir): # will just be runDir anyway
@@ -259,107 +434,41 @@ clkFileTemplate = gCfg['outputs']['clocks']['filename'] # save this, because it
 satData = [['clk_files',clkTemplate,''],['bsx_files',bsxTemplate,''],['sp3_files',sp3Template,'']]
 
 if args.daily:
-	for mjd in range(startMJD,stopMJD+1):
-		
-		ScrubDir(runDir)
-		ScrubDir(tmpDir)
-		
-		(yyyy,doy,mon) = ottp.MJDtoYYYYDOY(mjd)
-		yy = yyyy % 100
-		
-		ottp.Debug(f'Processing MJD={mjd} yyyy={yyyy} doy={doy}')
-		
-		# Do any necessary preprocessing of the station observation files, including decompression
-		# First, find the file
-		
-		(baseObsPath, compressionExt) = rinex.FindObservationFile(srcDir,rnxStation,yyyy,doy,3,True)
-		obsPath = baseObsPath + compressionExt # note that compression extensions are .gz and .Z, not .crx 
-		obsBaseName = os.path.basename(obsPath)
-		
-		# editrnxobs.py will decompress for us but then helpfully (and unnecessarily) recompress it
-		# So give it a decompressed file, which it will leave as is
-		#
-		# Copy the RINEX file to the temporary directory
-		# This is because we might be using files from another user's directory where
-		# we don't have permission to decompress in place 
-		# (and this use case is not supported by editrnxobs.py at present either)
+	jobs = [] # the days that pea is running on
+	failures = []
+	try:
+		for mjd in range(startMJD,stopMJD+1):
 			
-		shutil.copy(obsPath,tmpDir)
-		obsDecompressedPath,algo = rinex.Decompress(os.path.join(tmpDir,obsBaseName)) # this will be deleted so no need to save details for recompression
-		obsDecompressedBaseName = os.path.basename(obsDecompressedPath)
-		
-		ottp.Debug('Running ' + editRnxObs)
-		try:
-			cmdargs = [editRnxObs,'--tmpdir',tmpDir,'--excludegnss',exclusions,'--output',dstDir,obsDecompressedPath]
-			# print(cmdargs) # FIXME useful when debugging
-			x = subprocess.check_output(cmdargs) 
-		except Exception as e:
-			print(e)
-			ottp.ErrorExit('Failed to run ' + editRnxObs)
-		
-		ginanInputRINEX = os.path.join(dstDir,obsDecompressedBaseName)
-		if not(os.path.exists(ginanInputRINEX)): # hmmm no output
-			ottp.Debug(f'Expected {ginanInputRINEX} - not found!')
-			continue # not fatal
-		
-		# Customize the Ginan config after finding the file because we need the decompressed base name
-		# and write it out
-		gCfg['inputs']['gnss_observations']['rnx_inputs'] = [obsDecompressedBaseName] # pea grumbles if this is not a list, so give it a list
-		
-		for sd in satData:
-			dstDir = os.path.dirname(gCfg['inputs']['satellite_data'][sd[0]][0]) # destination directory
-			fileName = MJDtoIGSProductName(mjd,sd[1])
-			gCfg['inputs']['satellite_data'][sd[0]] = [os.path.join(dstDir,fileName)]
-			# lazy find
-			files = glob.glob(os.path.join(satDataSrcDir,fileName)+'*')
-			if files:
-				shutil.copy(files[0],dstDir)
-				rinex.Decompress(os.path.join(dstDir,os.path.basename(files[0])))
-			else:
-				pass # FIXME what do we do
-
-		clkFile = clkFileTemplate
-		if 'YYDDD' in clkFile:
-			clkFile = clkFile.replace('YYDDD',f'{yy:02d}{doy:03d}',1)
-			gCfg['outputs']['clocks']['filename']  =  clkFile
-		elif 'DDD0.YY' in clkFile:
-			clkFile = clkFile.replace('DDD0.YY',f'{doy:03d}{yy:02d}',1)
-			gCfg['outputs']['clocks']['filename']  =  clkFile
-		
-		# FIXME unlink this always ?
-		gCfgOut = os.path.join(runDir,'pppclk.yaml')
-		try:
-			fout = open(gCfgOut, 'w')
-		except:
-			ottp.ErrorExit('Unable to open ' + gCfgOut)
+			failures += WaitForJobs(jobs,nJobs) # for a free slot
 			
-		yaml.safe_dump(gCfg, fout, sort_keys = False) # We preserve the input order. Note that comments are stripped
-		
-		# Run 'pea'
-		ottp.Debug('Running pea')
-		tstart = time.time()
-		
-		if cfg['pea']['options']:
-			userArgs = cfg['pea']['options'].split()
-		else:
-			userArgs = []
+			if nJobs > 1: # each day gets its own run directory, so that the days don't trample on each other
+				runDir = os.path.join(baseRunDir,str(mjd))
+				tmpDir = os.path.join(runDir,'tmp')
+				for d in [runDir,tmpDir]:
+					if not os.path.isdir(d):
+						os.mkdir(d)
+				gCfg = MakeGinanCfg()
+				
+			ScrubDir(runDir)
+			ScrubDir(tmpDir)
 			
-		try:
-			cmdargs = [peaExec,'-y',gCfgOut] + userArgs
-			subprocess.check_output(cmdargs) 
-		except Exception as e:
-			print(e)
-			ottp.ErrorExit('Failed to run ' + peaExec)
-		tstop = time.time()
-		ottp.Debug('..done')
-		ottp.Debug('Job run time = {:g} s'.format(tstop-tstart))
-		
-		# Collect the output, namely the smoothed clock file
-		# Ginan appears to put _smoothed before the extension
-		base,ext = os.path.splitext(clkFile)
-		clkPath = os.path.join(gCfg['outputs']['clocks']['directory'],f'{base}_smoothed{ext}')
-		shutil.copy(clkPath,os.path.join(outputClockDir,clkFile))
-		ottp.Debug(f'CLK file in {outputClockDir}/{clkFile}')
+			try:
+				prepared = PrepareDay(mjd,gCfg)
+			except Exception as e: # not fatal, so that the other days still get processed
+				print('Failed to prepare MJD {} ({})'.format(mjd,e))
+				failures.append(mjd)
+				continue
+			if not(prepared):
+				continue
+			gCfgOut,clkFile = prepared
+			jobs.append(StartPea(mjd,gCfg,gCfgOut,clkFile))
+				
+		failures += WaitForJobs(jobs,1) # for everything to finish
+	except BaseException: # including ErrorExit and Ctrl-C
+		StopJobs(jobs)
+		raise
+	if failures:
+		ottp.ErrorExit('Processing failed for MJD ' + ' '.join([str(m) for m in failures]))
 				
 else: # output a single CLK file
 	
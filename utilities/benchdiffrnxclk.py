@@ -0,0 +1,360 @@
+#!/usr/bin/python3
+
+#
+# The MIT License (MIT)
+#
+# Copyright (c) 2024 Michael J. Wouters
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+#
+
+# Benchmarks diffrnxclk.py on synthetic RINEX clock files
+# The files mimic IGS final CLK products (many AR stations, interleaved by epoch, plus AS satellite records)
+# and single station PPP solutions
+#
+# Results can be checked against a baseline, to catch regressions. The reference baseline,
+# benchdiffrnxclk.baseline.json, was made with the default settings. Timings depend on the machine,
+# so regenerate it on the machine the checks are run on, after checking that the results are sound:
+#   benchdiffrnxclk.py --save benchdiffrnxclk.baseline.json
+# The tolerances are saved with the baseline and can be edited there.
+
+import argparse
+import datetime
+import gzip
+import json
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+AUTHORS = 'Michael Wouters'
+VERSION = '0.1.0'
+
+START_MJD = 60539
+NSATS = 32
+PAIR = ['SYDN','PTBB'] # the stations which are differenced
+OUTDIR = '<OUTDIR>' # placeholder in diffrnxclk.py arguments
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)),'benchdiffrnxclk.baseline.json')
+TOLERANCE = {'speed':0.5,'memory':0.2} # fractional slowdown and increase in peak memory allowed relative to the baseline
+
+# ------------------------------------------
+def Debug(msg):
+	if args.debug:
+		sys.stderr.write(msg + '\n')
+
+# ------------------------------------------
+def MJDtoDate(mjd):
+	return datetime.datetime(1858,11,17) + datetime.timedelta(days=mjd)
+
+# ------------------------------------------
+def RateTag(rate):
+	if rate % 60 == 0:
+		return '{:02d}M'.format(int(rate/60))
+	return '{:02d}S'.format(int(rate))
+
+# ------------------------------------------
+def ClkHeader(stations):
+	hdr  = '{:>9}{:11}{:<20}{:20}{:20}\n'.format('3.00','','C','','RINEX VERSION / TYPE')
+	hdr += '{:<20}{:<20}{:<20}{}\n'.format('benchdiffrnxclk.py','','','PGM / RUN BY / DATE')
+	hdr += '{:6d}{:>6}{:>6}{:42}{}\n'.format(2,'AR','AS','','# / TYPES OF DATA')
+	hdr += '{:6d}{:54}{}\n'.format(len(stations),'','# OF SOLN STA / TRF')
+	for s in stations:
+		hdr += '{:<4}{:56}{}\n'.format(s,'','SOLN STA NAME / NUM')
+	hdr += '{:60}{}\n'.format('','END OF HEADER')
+	return hdr
+
+# ------------------------------------------
+def WriteClkFile(fname,stations,mjd,rate,offsets,satellites,overlap=False):
+	# Writes a day of clock records for the stations, interleaved by epoch
+	# With overlap, the file ends with 00:00 of the next day, as Ginan's daily files do
+	# Returns the number of lines written
+	nLines = 0
+	epoch0 = MJDtoDate(mjd)
+	with open(fname,'w') as fout:
+		hdr = ClkHeader(stations)
+		fout.write(hdr)
+		nLines += hdr.count('\n')
+		for k in range(0,int(86400/rate) + int(overlap)):
+			dt = epoch0 + datetime.timedelta(seconds = k*rate)
+			tstr = '{:4d} {:02d} {:02d} {:02d} {:02d} {:9.6f}'.format(dt.year,dt.month,dt.day,dt.hour,dt.minute,dt.second)
+			tsec = (mjd - START_MJD)*86400 + k*rate
+			recs = []
+			for i,s in enumerate(stations):
+				clk = offsets[i] + 1.0E-13*i*tsec + random.gauss(0,2.0E-12)
+				recs.append('AR {:<4} {}  1   {:19.12e}\n'.format(s,tstr,clk))
+			if satellites:
+				for sv in range(1,NSATS+1):
+					recs.append('AS G{:02d} {}  1   {:19.12e}\n'.format(sv,tstr,1.0E-4*sv))
+			fout.writelines(recs)
+			nLines += len(recs)
+	return nLines
+
+# ------------------------------------------
+def MakeData(workDir,nStations,rate,nDays):
+	# Returns the number of lines in each kind of file (one day)
+
+	stations = PAIR + ['S{:03d}'.format(i) for i in range(0,nStations - len(PAIR))]
+	offsets  = [1.0E-9*i for i in range(0,len(stations))]
+
+	for d in ['single','igs','compressed','overlap']:
+		os.makedirs(os.path.join(workDir,d),exist_ok=True)
+
+	nLines = {}
+	for m in range(START_MJD,START_MJD + nDays):
+		dt = MJDtoDate(m)
+		yyyy = dt.year
+		doy = dt.timetuple().tm_yday
+		Debug('Generating MJD {:d}'.format(m))
+		# PPP-style files, one station each, with a day boundary jump
+		for i,s in enumerate(PAIR):
+			f = os.path.join(workDir,'single','{}{:02d}{:03d}.clk'.format(s,yyyy % 100,doy))
+			nLines['single'] = WriteClkFile(f,[s],m,rate,[offsets[i] + 1.0E-10*(m - START_MJD)],False)
+			f = os.path.join(workDir,'overlap','{}{:02d}{:03d}.clk'.format(s,yyyy % 100,doy))
+			WriteClkFile(f,[s],m,rate,[offsets[i] + 1.0E-10*(m - START_MJD)],False,True)
+		# IGS-style multi station file
+		fname = IGSName(yyyy,doy,rate)
+		f = os.path.join(workDir,'igs',fname)
+		nLines['igs'] = WriteClkFile(f,stations,m,rate,offsets,True)
+		with open(f,'rb') as fin:
+			with gzip.open(os.path.join(workDir,'compressed',fname + '.gz'),'wb',compresslevel=6) as fout:
+				shutil.copyfileobj(fin,fout)
+	return nLines
+
+# ------------------------------------------
+def IGSName(yyyy,doy,rate):
+	return 'IGS0OPSFIN_{:04d}{:03d}0000_01D_{}_CLK.CLK'.format(yyyy,doy,RateTag(rate))
+
+# ------------------------------------------
+def RunScenario(workDir,cmdargs,outFile):
+	# Runs diffrnxclk.py, returning the elapsed time, the peak RSS (MB) and the number of points in the output
+
+	outDir = os.path.join(workDir,'out')
+	if os.path.isdir(outDir):
+		shutil.rmtree(outDir)
+	os.mkdir(outDir)
+
+	cmd = [sys.executable,diffRnxClk] + [outDir if a == OUTDIR else a for a in cmdargs]
+	Debug(' '.join(cmd))
+	tstart = time.time()
+	proc = subprocess.Popen(cmd,stdout=subprocess.DEVNULL)
+	pid,status,rusage = os.wait4(proc.pid,0)
+	elapsed = time.time() - tstart
+	if status:
+		sys.exit('ERROR: {} failed'.format(' '.join(cmd)))
+
+	nPoints = 0
+	fout = os.path.join(outDir,outFile)
+	if os.path.exists(fout):
+		with open(fout,'r') as fin:
+			nPoints = sum(1 for l in fin)
+
+	return elapsed,rusage.ru_maxrss/1024.0,nPoints # ru_maxrss is in kB on Linux
+
+# ------------------------------------------
+def CheckIncremental(workDir,nDays):
+	# Checks that a difference file built incrementally, including reprocessing changed files, 
+	# is the same as one made in a single run
+	# Returns a list of problems
+	
+	dataDir = os.path.join(workDir,'overlap')
+	outDir = os.path.join(workDir,'incremental')
+	if os.path.isdir(outDir):
+		shutil.rmtree(outDir)
+	os.mkdir(outDir)
+	sta1,sta2 = PAIR
+	lastMJD = START_MJD + nDays - 1
+	
+	def Run(opts,start,stop):
+		cmd = [sys.executable,diffRnxClk] + opts + [f'{sta1}YYDDD.clk',f'{sta2}YYDDD.clk',dataDir,dataDir,outDir,str(start),str(stop)]
+		Debug(' '.join(cmd))
+		if subprocess.run(cmd,stdout=subprocess.DEVNULL).returncode:
+			sys.exit('ERROR: {} failed'.format(' '.join(cmd)))
+	
+	def Read(fname):
+		with open(os.path.join(outDir,fname),'r') as fin:
+			return fin.read()
+	
+	Run([],START_MJD,lastMJD)
+	full = Read(f'{sta1}.{sta2}.{START_MJD}.{lastMJD}.diff.dat')
+	
+	problems = []
+	incremental = f'{sta1}.{sta2}.diff.dat'
+	for m in range(START_MJD,lastMJD + 1): # a day at a time, as from a cron job
+		Run(['--incremental'],START_MJD,m)
+	if not(Read(incremental) == full):
+		problems.append('adding a day at a time differs from a full run')
+	
+	for m in [START_MJD,START_MJD + nDays//2,START_MJD]: # reprocess days, as if their files had been replaced
+		dt = MJDtoDate(m)
+		for s in PAIR:
+			f = os.path.join(dataDir,'{}{:02d}{:03d}.clk'.format(s,dt.year % 100,dt.timetuple().tm_yday))
+			st = os.stat(f)
+			os.utime(f,ns=(st.st_atime_ns,st.st_mtime_ns + 1000000000))
+		Run(['--incremental'],START_MJD,lastMJD)
+		if not(Read(incremental) == full):
+			problems.append('reprocessing MJD {:d} differs from a full run'.format(m))
+	
+	os.unlink(os.path.join(outDir,incremental))
+	os.unlink(os.path.join(outDir,f'{sta1}.{sta2}.diff.state'))
+	for m in list(range(START_MJD + 1,lastMJD + 1)) + [START_MJD]: # an earlier day turns up late
+		Run(['--incremental'],m,m)
+	if not(Read(incremental) == full):
+		problems.append('inserting a day differs from a full run')
+	
+	return problems
+
+# --------------------------------------------------------------------------------------------------------
+
+examples =  'Usage examples\n'
+examples += '1. Check for regressions against the reference baseline\n'
+examples += '    benchdiffrnxclk.py --baseline ' + BASELINE + '\n'
+examples += '2. Run the benchmarks with 300 stations at 30 s, saving the results as the reference baseline\n'
+examples += '    benchdiffrnxclk.py --save ' + BASELINE + '\n'
+
+parser = argparse.ArgumentParser(description='Benchmarks diffrnxclk.py using synthetic RINEX clock files',
+	formatter_class=argparse.RawDescriptionHelpFormatter,epilog=examples)
+
+parser.add_argument('--stations',help='number of AR stations in the multi-station files (default 300)',default='300')
+parser.add_argument('--rate',help='sampling interval in seconds (default 30)',default='30')
+parser.add_argument('--days',help='number of days of data (default 3)',default='3')
+parser.add_argument('--repeat',help='number of times each scenario is run, the best time being used (default 3)',default='3')
+parser.add_argument('--workdir',help='directory for the synthetic data (default is a temporary directory, which is removed)')
+parser.add_argument('--diffrnxclk',help='path to diffrnxclk.py (default is the one alongside this script)',
+	default=os.path.join(os.path.dirname(os.path.abspath(__file__)),'diffrnxclk.py'))
+parser.add_argument('--baseline',help='check results against this baseline (JSON)')
+parser.add_argument('--save',help='save the results as a baseline (JSON)')
+parser.add_argument('--tolerance',help='fractional slowdown/increase in memory allowed relative to the baseline (default is the baseline\'s, or {:g} and {:g})'.format(
+	TOLERANCE['speed'],TOLERANCE['memory']))
+parser.add_argument('--debug','-d',help='debug (to stderr)',action='store_true')
+parser.add_argument('--version','-v',action='version',version = os.path.basename(sys.argv[0])+ ' ' + VERSION + '\n' + 'Written by ' + AUTHORS)
+
+args = parser.parse_args()
+
+diffRnxClk = args.diffrnxclk
+nStations = int(args.stations)
+rate = float(args.rate)
+nDays = int(args.days)
+nRepeats = int(args.repeat)
+tolerance = dict(TOLERANCE)
+if args.tolerance:
+	tolerance = {'speed':float(args.tolerance),'memory':float(args.tolerance)}
+
+random.seed(1) # reproducible data
+
+if args.workdir:
+	workDir = args.workdir
+	os.makedirs(workDir,exist_ok=True)
+else:
+	workDir = tempfile.mkdtemp(prefix='benchdiffrnxclk')
+
+print('Generating {:d} days of data for {:d} stations at {:g} s in {}'.format(nDays,nStations,rate,workDir))
+nLines = MakeData(workDir,nStations,rate,nDays)
+epochsPerDay = int(86400/rate)
+
+sta1,sta2 = PAIR
+igsTemplate = 'IGS0OPSFIN_YYYYDDD0000_01D_{}_CLK.CLK'.format(RateTag(rate))
+lastMJD = START_MJD + nDays - 1
+single = os.path.join(workDir,'single')
+igs = os.path.join(workDir,'igs')
+compressed = os.path.join(workDir,'compressed')
+
+# Each scenario is [name,diffrnxclk.py arguments,output file,lines read,expected points]
+scenarios = [
+	['single-pair',[f'{sta1}YYDDD.clk',f'{sta2}YYDDD.clk',single,single,OUTDIR,str(START_MJD),str(START_MJD)],
+		f'{sta1}.{sta2}.{START_MJD}.{START_MJD}.diff.dat',2*nLines['single'],epochsPerDay],
+	['same-file',['--sta1match',sta1,'--sta2match',sta2,igsTemplate,igsTemplate,igs,igs,OUTDIR,str(START_MJD),str(START_MJD)],
+		f'{sta1}.{sta2}.{START_MJD}.{START_MJD}.diff.dat',2*nLines['igs'],epochsPerDay],
+	['same-file-indexed',['--index','--sta1match',sta1,'--sta2match',sta2,igsTemplate,igsTemplate,igs,igs,OUTDIR,str(START_MJD),str(START_MJD)],
+		f'{sta1}.{sta2}.{START_MJD}.{START_MJD}.diff.dat',2*nLines['igs'],epochsPerDay],
+	['multi-day',['--stitch','--screen',f'{sta1}YYDDD.clk',f'{sta2}YYDDD.clk',single,single,OUTDIR,str(START_MJD),str(lastMJD)],
+		f'{sta1}.{sta2}.{START_MJD}.{lastMJD}.diff.dat',2*nDays*nLines['single'],nDays*epochsPerDay],
+	['compressed',['--sta1match',sta1,'--sta2match',sta2,igsTemplate,igsTemplate,compressed,compressed,OUTDIR,str(START_MJD),str(START_MJD)],
+		f'{sta1}.{sta2}.{START_MJD}.{START_MJD}.diff.dat',2*nLines['igs'],epochsPerDay],
+]
+
+results = {'stations':nStations,'rate':rate,'days':nDays,'tolerance':tolerance,'scenarios':{}}
+failed = False
+
+print('{:<18} {:>9} {:>12} {:>12} {:>10}'.format('scenario','time (s)','lines/s','points/s','peak (MB)'))
+for name,cmdargs,outFile,linesRead,expectedPoints in scenarios:
+	if name == 'same-file-indexed': # build the index first, so that the indexed read is timed
+		RunScenario(workDir,cmdargs,outFile)
+	best = None
+	for r in range(0,nRepeats):
+		elapsed,peakMB,nPoints = RunScenario(workDir,cmdargs,outFile)
+		if best is None or elapsed < best[0]:
+			best = [elapsed,peakMB,nPoints]
+	elapsed,peakMB,nPoints = best
+	res = {'time':elapsed,'lines per s':linesRead/elapsed,'points per s':nPoints/elapsed,'peak MB':peakMB,'points':nPoints}
+	results['scenarios'][name] = res
+	print('{:<18} {:9.3f} {:12.4g} {:12.4g} {:10.1f}'.format(name,elapsed,res['lines per s'],res['points per s'],peakMB))
+	if not(nPoints == expectedPoints):
+		print('  FAIL: {:d} points matched, expected {:d}'.format(nPoints,expectedPoints))
+		failed = True
+
+# The point of the index is that extracting a station costs less than scanning the file
+indexed = results['scenarios']['same-file-indexed']
+unindexed = results['scenarios']['same-file']
+if not(indexed['time'] < unindexed['time']):
+	print('  FAIL: same-file-indexed took {:.3f} s, same-file {:.3f} s'.format(indexed['time'],unindexed['time']))
+	failed = True
+if indexed['peak MB'] > unindexed['peak MB']:
+	print('  FAIL: same-file-indexed peak {:.1f} MB, same-file {:.1f} MB'.format(indexed['peak MB'],unindexed['peak MB']))
+	failed = True
+
+# An incrementally maintained difference file must be the same as one made in one go
+for p in CheckIncremental(workDir,nDays):
+	print('  FAIL: incremental: ' + p)
+	failed = True
+
+if args.baseline:
+	with open(args.baseline,'r') as fin:
+		baseline = json.load(fin)
+	if not(baseline['stations'] == nStations and baseline['rate'] == rate and baseline['days'] == nDays):
+		print('Warning: the baseline was made with different data (stations {} rate {} days {})'.format(
+			baseline['stations'],baseline['rate'],baseline['days']))
+	if not(args.tolerance) and 'tolerance' in baseline:
+		tolerance = baseline['tolerance']
+	for name,res in results['scenarios'].items():
+		if not(name in baseline['scenarios']):
+			continue
+		base = baseline['scenarios'][name]
+		if res['lines per s'] < (1.0 - tolerance['speed'])*base['lines per s']:
+			print('  REGRESSION {}: {:.4g} lines/s, baseline {:.4g}'.format(name,res['lines per s'],base['lines per s']))
+			failed = True
+		if res['peak MB'] > (1.0 + tolerance['memory'])*base['peak MB']:
+			print('  REGRESSION {}: peak {:.1f} MB, baseline {:.1f} MB'.format(name,res['peak MB'],base['peak MB']))
+			failed = True
+		if not(res['points'] == base['points']):
+			print('  REGRESSION {}: {:d} points, baseline {:d}'.format(name,res['points'],base['points']))
+			failed = True
+
+if args.save:
+	with open(args.save,'w') as fout:
+		json.dump(results,fout,indent=1)
+	print('Results saved to ' + args.save)
+
+if not(args.workdir):
+	shutil.rmtree(workDir)
+
+if failed:
+	sys.exit(1)
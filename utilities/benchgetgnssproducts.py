@@ -0,0 +1,466 @@
+#!/usr/bin/python3
+
+#
+# The MIT License (MIT)
+#
+# Copyright (c) 2024 Michael J. Wouters
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+#
+
+# Tests getgnssproducts.py against a local stand-in for CDDIS
+# A synthetic archive (products/<GPS week>, data/daily/...) is served over HTTP, with simulated
+# latency, limited bandwidth, missing files, login pages, corrupt files and dropped connections.
+# Download throughput is measured, and the downloaded files are checked against the originals.
+
+import argparse
+import base64
+import datetime
+import gzip
+import http.server
+import json
+import os
+import random
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.parse
+
+AUTHORS = 'Michael Wouters'
+VERSION = '0.1.0'
+
+START_MJD = 60539
+STATION = 'SYDN00AUS'
+WRITE_SIZE = 65536 # bytes sent at a time by the server
+
+# Simulated faults
+MISSING = 'missing'
+LOGIN   = 'login'
+CORRUPT = 'corrupt'
+DROP    = 'drop'
+STALL   = 'stall' # every transfer is dropped after an eighth of the file, so the download is given up
+RESUME_LOGIN = 'resume login' # every transfer is dropped half way, and resuming it gets the login page
+LISTING_LOGIN = 'listing login' # a directory that redirects to the login page
+LISTING_OAUTH = 'listing oauth' # a directory that redirects to the login page, which redirects back with a cookie
+
+# ------------------------------------------
+def Debug(msg):
+	if args.debug:
+		sys.stderr.write(msg + '\n')
+
+# ------------------------------------------
+def MJDtoDate(mjd):
+	return datetime.datetime(1858,11,17) + datetime.timedelta(days=mjd)
+
+# ------------------------------------------
+def ArchiveFiles(mjd):
+	# Returns the paths, relative to the archive root, of the files that getgnssproducts.py
+	# will ask for on this day, with the options used here
+	dt = MJDtoDate(mjd)
+	yyyy = dt.year
+	yy = yyyy % 100
+	doy = dt.timetuple().tm_yday
+	wn = int((mjd - 44244)/7) # GPS week
+	return [
+		'products/{:04d}/IGS0OPSRAP_{:04d}{:03d}0000_01D_05M_CLK.CLK.gz'.format(wn,yyyy,doy),
+		'products/{:04d}/IGS0OPSRAP_{:04d}{:03d}0000_01D_15M_ORB.SP3.gz'.format(wn,yyyy,doy),
+		'products/{:04d}/IGS0OPSRAP_{:04d}{:03d}0000_01D_01D_ERP.ERP.gz'.format(wn,yyyy,doy),
+		'products/{:04d}/COD0OPSRAP_{:04d}{:03d}0000_01D_01D_OSB.BIA.gz'.format(wn,yyyy,doy),
+		'data/daily/{:04d}/{:03d}/{:02d}p/{}_R_{:04d}{:03d}0000_01D_MN.rnx.gz'.format(yyyy,doy,yy,STATION,yyyy,doy),
+		'data/daily/{:04d}/{:03d}/{:02d}d/{}_R_{:04d}{:03d}0000_01D_30S_MO.crx.gz'.format(yyyy,doy,yy,STATION,yyyy,doy)
+	]
+
+# ------------------------------------------
+def MakeArchive(archiveDir,nDays,size):
+	# Makes the archive, with files of roughly size bytes (compressed)
+	# Returns a list of the files
+	files = []
+	for m in range(START_MJD,START_MJD + nDays):
+		Debug('Generating MJD {:d}'.format(m))
+		for f in ArchiveFiles(m):
+			path = os.path.join(archiveDir,f)
+			os.makedirs(os.path.dirname(path),exist_ok=True)
+			# base64 text compresses to about the size of the random bytes, which is close enough to real products
+			text = base64.encodebytes(random.randbytes(size))
+			with gzip.open(path,'wb',compresslevel=6) as fout:
+				fout.write(text)
+			files.append(f)
+	return files
+
+# ------------------------------------------
+class ArchiveHandler(http.server.BaseHTTPRequestHandler):
+
+	protocol_version = 'HTTP/1.1' # so that connections can be reused
+
+	def log_message(self,format,*args):
+		pass
+
+	def SendBody(self,code,body,contentType,extraHeaders={}):
+		self.send_response(code)
+		self.send_header('Content-Type',contentType)
+		self.send_header('Content-Length',str(len(body)))
+		for h,v in extraHeaders.items():
+			self.send_header(h,v)
+		self.end_headers()
+		if self.command != 'HEAD':
+			self.wfile.write(body)
+
+	def do_HEAD(self):
+		self.do_GET()
+
+	def do_GET(self):
+		time.sleep(self.server.latency)
+		path = urllib.parse.urlparse(self.path).path
+		rel = path.lstrip('/')
+
+		if rel == 'login': # where the login redirect goes
+			query = urllib.parse.parse_qs(urllib.parse.urlparse(self.path).query)
+			if 'oauth' in query: # logged in straight away, so back to where we came from
+				self.send_response(302)
+				self.send_header('Location',query['redirect'][0])
+				self.send_header('Set-Cookie','session=1; Path=/')
+				self.send_header('Content-Length','0')
+				self.end_headers()
+				return
+			self.SendBody(200,b'<html><body>Earthdata Login</body></html>','text/html')
+			return
+
+		with self.server.lock:
+			self.server.requested.add(rel)
+		fault = self.server.faults.get(rel)
+		if fault == LISTING_OAUTH and not('session=1' in self.headers.get('Cookie','')):
+			self.send_response(302)
+			self.send_header('Location','/login?oauth=1&redirect=' + urllib.parse.quote(path))
+			self.send_header('Content-Length','0')
+			self.end_headers()
+			return
+		if fault in [LOGIN,LISTING_LOGIN] or (fault == RESUME_LOGIN and 'Range' in self.headers):
+			self.send_response(302)
+			self.send_header('Location','/login?redirect=' + urllib.parse.quote(path))
+			self.send_header('Content-Length','0')
+			self.end_headers()
+			return
+
+		local = os.path.join(self.server.root,rel)
+		if path.endswith('/') and os.path.isdir(local): # directory listing
+			items = ''.join(['<a href="{}">{}</a>\n'.format(f,f) for f in sorted(os.listdir(local))])
+			self.SendBody(200,'<html><head><title>Index of {}</title></head><body><pre>\n{}</pre></body></html>'.format(path,items).encode(),'text/html')
+			return
+		if not(os.path.isfile(local)):
+			self.SendBody(404,b'<html><body>Not found</body></html>','text/html')
+			return
+
+		with open(local,'rb') as fin:
+			data = fin.read()
+		if fault == CORRUPT: # damage the CRC
+			data = data[:-6] + bytes([data[-6] ^ 0xff]) + data[-5:]
+
+		start = 0
+		m = re.match(r'bytes=(\d+)-$',self.headers.get('Range',''))
+		if m:
+			start = int(m.group(1))
+			if start >= len(data):
+				self.SendBody(416,b'',"text/plain",{'Content-Range':'bytes */{:d}'.format(len(data))})
+				return
+			self.send_response(206)
+			self.send_header('Content-Range','bytes {:d}-{:d}/{:d}'.format(start,len(data) - 1,len(data)))
+		else:
+			self.send_response(200)
+		self.send_header('Content-Type','application/octet-stream')
+		self.send_header('Content-Length',str(len(data) - start))
+		self.end_headers()
+		if self.command == 'HEAD':
+			return
+
+		body = data[start:]
+		stop = len(body)
+		if fault == RESUME_LOGIN:
+			stop = int(len(body)/2)
+		elif fault == DROP:
+			with self.server.lock:
+				if not(rel in self.server.dropped): # only the first transfer is dropped
+					self.server.dropped.add(rel)
+					stop = int(len(body)/2)
+		elif fault == STALL:
+			stop = min(stop,int(len(data)/8))
+
+		# Send at no more than the bandwidth limit
+		tStart = time.time()
+		sent = 0
+		while sent < stop:
+			n = min(WRITE_SIZE,stop - sent)
+			self.wfile.write(body[sent:sent + n])
+			sent += n
+			if self.server.bandwidth > 0:
+				ahead = sent/self.server.bandwidth - (time.time() - tStart)
+				if ahead > 0:
+					time.sleep(ahead)
+		if stop < len(body):
+			self.wfile.flush()
+			self.close_connection = True
+
+# ------------------------------------------
+def StartServer(root,latency,bandwidth):
+	server = http.server.ThreadingHTTPServer(('127.0.0.1',0),ArchiveHandler)
+	server.daemon_threads = True
+	server.root = root
+	server.latency = latency
+	server.bandwidth = bandwidth
+	server.faults = {}
+	server.dropped = set()
+	server.requested = set()
+	server.lock = threading.Lock()
+	threading.Thread(target=server.serve_forever,daemon=True).start()
+	return server
+
+# ------------------------------------------
+def WriteConfig(cfgFile,port):
+	with open(cfgFile,'w') as fout:
+		fout.write('[Main]\n')
+		fout.write('Data centres = CDDIS\n\n')
+		fout.write('[CDDIS]\n')
+		fout.write('base URL = http://127.0.0.1:{:d}/archive/gnss\n'.format(port))
+		fout.write('broadcast ephemeris = data/daily\n')
+		fout.write('products = products\n')
+		fout.write('station data = data/daily\n')
+		fout.write('bias = products/bias\n')
+		fout.write('osb bias = products\n')
+		fout.write('dcb bias = products/bias\n')
+
+# ------------------------------------------
+def RunScenario(workDir,cfgFile,nDays,extraArgs,fresh):
+	# Runs getgnssproducts.py, returning the elapsed time and the summary from the transfer log
+	# Unless fresh, the downloads and database of the previous scenario are kept
+
+	runDir = os.path.join(workDir,'run')
+	outDir = os.path.join(runDir,'out')
+	logFile = os.path.join(runDir,'transfers.jsonl')
+	if fresh and os.path.isdir(runDir):
+		shutil.rmtree(runDir)
+	os.makedirs(outDir,exist_ok=True)
+	if os.path.exists(logFile):
+		os.unlink(logFile)
+
+	cmd = [sys.executable,getGNSSProducts,'--config',cfgFile,'--noproxy','--centre','CDDIS',
+		'--rapid','--clocks','--orbits','--erp','--bias','--ephemeris','--observations','--statid',STATION,
+		'--rapiddir',outDir,'--biasdir',outDir,'--outputdir',outDir,
+		'--database',os.path.join(runDir,'getgnssproducts.db'),'--log',logFile] + extraArgs + [
+		str(START_MJD),str(START_MJD + nDays - 1)]
+	Debug(' '.join(cmd))
+	env = dict(os.environ)
+	env['HOME'] = workDir # getgnssproducts.py needs somewhere
+	tStart = time.time()
+	proc = subprocess.run(cmd,stdout=subprocess.DEVNULL if not(args.debug) else None,env=env)
+	elapsed = time.time() - tStart
+	if proc.returncode:
+		sys.exit('ERROR: {} failed'.format(' '.join(cmd)))
+
+	summary = None
+	retries = 0
+	with open(logFile,'r') as fin:
+		for line in fin:
+			rec = json.loads(line)
+			if rec['type'] == 'summary':
+				summary = rec
+			else:
+				retries += rec['retries']
+	summary['retries'] = retries
+	return elapsed,summary,outDir
+
+# ------------------------------------------
+def CheckDownloads(archiveDir,outDir,files,faults):
+	# Checks that each good file was downloaded intact and that nothing bad was left behind
+	# Returns a list of problems
+	problems = []
+	for f in files:
+		dst = os.path.join(outDir,os.path.basename(f))
+		fault = faults.get(f)
+		if fault in [STALL,RESUME_LOGIN]: # given up, so the partial download should be kept for the next run
+			if not(os.path.exists(dst + '.part')):
+				problems.append('partial download not kept: ' + dst)
+			if os.path.exists(dst):
+				problems.append('{} file was saved: {}'.format(fault,dst))
+			continue
+		if os.path.exists(dst + '.part'):
+			problems.append('partial download left behind: ' + dst)
+		if fault in [MISSING,LOGIN,CORRUPT]:
+			if os.path.exists(dst):
+				problems.append('{} file was saved: {}'.format(fault,dst))
+			continue
+		if not(os.path.exists(dst)):
+			problems.append('not downloaded: ' + dst)
+			continue
+		with open(os.path.join(archiveDir,f),'rb') as f1, open(dst,'rb') as f2:
+			if f1.read() != f2.read():
+				problems.append('differs from the original: ' + dst)
+	return problems
+
+# --------------------------------------------------------------------------------------------------------
+
+examples =  'Usage examples\n'
+examples += '1. Run the tests with a week of data\n'
+examples += '    benchgetgnssproducts.py\n'
+examples += '2. Simulate a slow, distant server and save the results\n'
+examples += '    benchgetgnssproducts.py --latency 300 --bandwidth 500 --save results.json\n'
+
+parser = argparse.ArgumentParser(description='Tests getgnssproducts.py against a local stand-in for CDDIS',
+	formatter_class=argparse.RawDescriptionHelpFormatter,epilog=examples)
+
+parser.add_argument('--days',help='number of days of products (default 7)',default='7')
+parser.add_argument('--size',help='size of each file in kB (default 500)',default='500')
+parser.add_argument('--latency',help='latency of each request in ms (default 50)',default='50')
+parser.add_argument('--bandwidth',help='bandwidth of each connection in kB/s, 0 for no limit (default 2000)',default='2000')
+parser.add_argument('--jobs','-j',help='number of simultaneous downloads in the concurrent scenarios (default 8)',default='8')
+parser.add_argument('--workdir',help='directory for the synthetic archive (default is a temporary directory, which is removed)')
+parser.add_argument('--getgnssproducts',help='path to getgnssproducts.py (default is the one alongside this script)',
+	default=os.path.join(os.path.dirname(os.path.abspath(__file__)),'getgnssproducts.py'))
+parser.add_argument('--save',help='save the results (JSON)')
+parser.add_argument('--debug','-d',help='debug (to stderr)',action='store_true')
+parser.add_argument('--version','-v',action='version',version = os.path.basename(sys.argv[0])+ ' ' + VERSION + '\n' + 'Written by ' + AUTHORS)
+
+args = parser.parse_args()
+
+getGNSSProducts = args.getgnssproducts
+nDays = int(args.days)
+size = int(args.size)*1000
+nJobs = args.jobs
+
+random.seed(1) # reproducible data and faults
+
+if args.workdir:
+	workDir = args.workdir
+	os.makedirs(workDir,exist_ok=True)
+else:
+	workDir = tempfile.mkdtemp(prefix='benchgetgnssproducts')
+
+serverRoot = os.path.join(workDir,'srv')
+archiveDir = os.path.join(serverRoot,'archive','gnss')
+if os.path.isdir(archiveDir):
+	shutil.rmtree(archiveDir)
+print('Generating {:d} days of products in {}'.format(nDays,workDir))
+files = MakeArchive(archiveDir,nDays,size)
+totalBytes = sum([os.path.getsize(os.path.join(archiveDir,f)) for f in files])
+
+server = StartServer(serverRoot,float(args.latency)/1000.0,float(args.bandwidth)*1000.0)
+cfgFile = os.path.join(workDir,'getgnssproducts.conf')
+WriteConfig(cfgFile,server.server_address[1])
+
+# Faults for the resume and validation scenarios
+shuffled = random.sample(files,len(files))
+dropped = dict([(f,DROP) for f in shuffled[:max(1,int(len(files)/3))]])
+bad = {}
+for i,fault in enumerate([MISSING,MISSING,LOGIN,LOGIN,CORRUPT,CORRUPT]):
+	bad[shuffled[i % len(shuffled)]] = fault
+
+# Downloads that are given up, to be resumed by the following run
+bySize = sorted(files,key=lambda f: os.path.getsize(os.path.join(archiveDir,f)))
+stalled = dict([(f,STALL) for f in bySize[-2:]] + [(bySize[-3],RESUME_LOGIN)])
+
+# A directory that can't be listed because it redirects to the login page, so its files have to be fetched blind
+listingLogin = {os.path.dirname(files[0]) + '/':LISTING_LOGIN}
+
+# A directory that can only be listed after a login, which the OAuth redirects take care of
+# The listing should be used, so the missing file in it is not asked for
+listingOAuth = {os.path.dirname(files[0]) + '/':LISTING_OAUTH,files[0]:MISSING}
+
+# Each scenario is [name,getgnssproducts.py arguments,faults,whether to start afresh]
+scenarios = [
+	['sequential',['--jobs','1'],{},True],
+	['concurrent',['--jobs',nJobs,'--hostjobs',nJobs],{},True],
+	['resume',['--jobs',nJobs,'--hostjobs',nJobs],dropped,True],
+	['giveup',['--jobs',nJobs,'--hostjobs',nJobs],stalled,True],
+	['rerun',['--jobs',nJobs,'--hostjobs',nJobs,'--retry'],{},False], # resumes the downloads given up by the previous run
+	['hostlimit',['--jobs',nJobs,'--hostjobs','1'],stalled,True], # other downloads go ahead while the failing ones wait to retry
+	['validation',['--jobs',nJobs,'--hostjobs',nJobs],bad,True],
+	['listing',['--jobs',nJobs,'--hostjobs',nJobs],listingLogin,True],
+	['oauth',['--jobs',nJobs,'--hostjobs',nJobs],listingOAuth,True],
+]
+
+results = {'files':len(files),'bytes':totalBytes,'latency':args.latency,'bandwidth':args.bandwidth,'scenarios':{}}
+failed = False
+
+print('{:<12} {:>9} {:>9} {:>11} {:>8} {:>8} {:>8}'.format('scenario','time (s)','MB/s','downloaded','missing','failed','retries'))
+for name,cmdargs,faults,fresh in scenarios:
+
+	server.faults = dict([('archive/gnss/' + f,fault) for f,fault in faults.items()]) # as the server sees them
+	server.dropped = set()
+	server.requested = set()
+	missing = [f for f,fault in faults.items() if fault == MISSING]
+	for f in missing: # hide it
+		os.rename(os.path.join(archiveDir,f),os.path.join(archiveDir,f + '.hidden'))
+
+	partBytes = 0 # already downloaded by the previous run
+	outDir = os.path.join(workDir,'run','out')
+	if not(fresh):
+		pending = [f for f in files if not(os.path.exists(os.path.join(outDir,os.path.basename(f))))]
+		partBytes = sum([os.path.getsize(os.path.join(outDir,os.path.basename(f) + '.part')) for f in pending
+			if os.path.exists(os.path.join(outDir,os.path.basename(f) + '.part'))])
+
+	elapsed,summary,outDir = RunScenario(workDir,cfgFile,nDays,cmdargs,fresh)
+
+	for f in missing:
+		os.rename(os.path.join(archiveDir,f + '.hidden'),os.path.join(archiveDir,f))
+
+	counts = summary['counts']
+	nDownloaded = counts.get('downloaded',0)
+	nMissing = counts.get('missing',0)
+	nFailed = counts.get('failed',0)
+	res = {'time':elapsed,'MB per s':summary['bytes']/elapsed/1.0E6,'counts':counts,'retries':summary['retries']}
+	results['scenarios'][name] = res
+	print('{:<12} {:9.3f} {:9.3f} {:11d} {:8d} {:8d} {:8d}'.format(name,elapsed,res['MB per s'],nDownloaded,nMissing,nFailed,summary['retries']))
+
+	problems = CheckDownloads(archiveDir,outDir,files,faults)
+	nBad = len([f for f in faults.values() if f in [LOGIN,CORRUPT,STALL,RESUME_LOGIN]])
+	expected = [len(files) - len(missing) - nBad,len(missing),nBad]
+	if not(fresh): # only what the previous run didn't finish
+		expected = [len(pending),0,0]
+		if partBytes == 0:
+			problems.append('no partial downloads to resume')
+		if summary['bytes'] > sum([os.path.getsize(os.path.join(archiveDir,f)) for f in pending]) - partBytes:
+			problems.append('partial downloads were not resumed')
+	if not([nDownloaded,nMissing,nFailed] == expected):
+		problems.append('expected {:d} downloaded, {:d} missing, {:d} failed'.format(*expected))
+	if name == 'hostlimit' and elapsed > 1.5*results['scenarios']['giveup']['time']:
+		problems.append('downloads waiting to retry held up the others ({:.1f} s, {:.1f} s without the host limit)'.format(
+			elapsed,results['scenarios']['giveup']['time']))
+	if name == 'oauth' and ('archive/gnss/' + files[0]) in server.requested:
+		problems.append('the listing was not used')
+	if name == 'resume' and summary['retries'] < len(dropped):
+		problems.append('expected at least {:d} retries'.format(len(dropped)))
+	for p in problems:
+		print('  FAIL: ' + p)
+	if problems:
+		failed = True
+
+server.shutdown()
+
+if args.save:
+	with open(args.save,'w') as fout:
+		json.dump(results,fout,indent=1)
+	print('Results saved to ' + args.save)
+
+if not(args.workdir):
+	shutil.rmtree(workDir)
+
+if failed:
+	sys.exit(1)
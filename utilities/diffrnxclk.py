@@ -29,7 +29,12 @@
 
 import argparse
 import datetime
+import gzip
+import json
+import mmap
 import os
+import re
+import subprocess
 import sys
 
 sys.path.append("/usr/local/lib/python3.6/site-packages")  # Ubuntu 18.04
@@ -38,8 +43,489 @@ sys.path.append("/usr/local/lib/python3.10/site-packages") # Ubuntu 22.04
 
 import ottplib as ottp
 
+try:
+	import numpy as np
+except ImportError:
+	sys.exit('ERROR: Must install numpy\n eg pip3 install numpy')
+
 AUTHORS = 'Michael Wouters'
-VERSION = '2.1.1'
+VERSION = '2.2.0'
+
+STITCH_SLOPE_PTS = 10 # number of points used to estimate the clock rate either side of an arc boundary
+MATCH_TOLERANCE = 0.001 # in seconds, for treating time stamps as equal when interpolating
+COMPRESSION_EXTENSIONS = ['.gz','.Z'] # tried in turn if the uncompressed CLK file is not found
+INDEX_EXTENSION = '.idx.npz' # appended to the CLK file name to make the name of the station index
+
+SCREEN_WINDOW = 31      # points in the rolling median used for outlier detection
+SCREEN_CHUNK  = 100000  # points per block in the rolling median, which copies the window view (SCREEN_WINDOW x 8 bytes per point, so 25 MB)
+GAP_FACTOR    = 1.5     # a gap is flagged when the time between points exceeds this multiple of the nominal interval
+
+# Screening flags (bitwise OR'ed)
+FLAG_OUTLIER = 1
+FLAG_STEP    = 2 # phase step between this point and the previous one
+FLAG_GAP     = 4 # gap between this point and the previous one
+
+clkIndexes = {} # loaded station indexes, keyed by CLK file name, since both stations may be in the same file
+
+# ------------------------------------------
+def FindCLK(fclk):
+	# Returns the path to the CLK file, or a compressed version of it, or None if not found/empty
+	for ext in [''] + COMPRESSION_EXTENSIONS:
+		f = fclk + ext
+		if os.path.exists(f) and os.path.getsize(f) > 0:
+			return f
+	ottp.Debug('{} is  missing/empty'.format(fclk))
+	return None
+
+# ------------------------------------------
+def OpenCLK(fclk):
+	# Returns a text stream for the CLK file, decompressing on the fly if necessary, 
+	# and the decompression process (if there is one)
+	if fclk.endswith('.gz'):
+		return gzip.open(fclk,'rt'),None
+	elif fclk.endswith('.Z'): # no support for LZW in the standard library, but gzip can do it
+		proc = subprocess.Popen(['gzip','-dc',fclk],stdout=subprocess.PIPE,text=True)
+		return proc.stdout,proc
+	return open(fclk,'r'),None
+
+# ------------------------------------------
+def FilterCLK(fclk,stamatch):
+	# Returns the station's AR records from an uncompressed CLK file
+	# The regex runs over the mmap'ed file, which is much faster than testing each line in Python
+	# Anchoring on '\n' rather than '^' lets the regex engine do a fast literal search
+	# (the first line is always a header line)
+	pattern = re.compile(rb'\n(AR ' + re.escape(stamatch.encode()) + rb'[^\n]*)')
+	with open(fclk,'rb') as fin:
+		with mmap.mmap(fin.fileno(),0,access=mmap.ACCESS_READ) as mm:
+			return [m.group(1).decode() for m in pattern.finditer(mm)]
+
+# ------------------------------------------
+def BuildIndex(fclk):
+	# Indexes the AR records of every station in an uncompressed CLK file
+	# For each station, the byte range [start,stop) of each of its records is recorded.
+	# Each station's ranges are a separate member of the index file, so that extracting
+	# one station only has to read that station's part of the index.
+	# The index is saved in a sidecar file, if possible, and returned
+	
+	pattern = re.compile(rb'\n(AR (\S+)[^\n]*)')
+	with open(fclk,'rb') as fin:
+		with mmap.mmap(fin.fileno(),0,access=mmap.ACCESS_READ) as mm:
+			matches = [(m.group(2),m.start(1),m.end(1)) for m in pattern.finditer(mm)]
+			fileSize = len(mm)
+	
+	stations,staIndex = np.unique(np.array([m[0].decode() for m in matches],dtype=str),return_inverse = True)
+	ranges = np.empty((len(matches),2),dtype=np.int64)
+	ranges[:,0] = [m[1] for m in matches]
+	ranges[:,1] = np.minimum(np.array([m[2] for m in matches],dtype=np.int64) + 1,fileSize) # include the line terminator
+	
+	# Group by station, keeping the file order
+	order = np.argsort(staIndex,kind='stable')
+	bounds = np.searchsorted(staIndex[order],np.arange(len(stations) + 1))
+	records = {}
+	for i in range(0,len(stations)):
+		records[i] = ranges[order[bounds[i]:bounds[i+1]]]
+	
+	st = os.stat(fclk)
+	index = {'size':st.st_size,'mtime':st.st_mtime_ns,'stations':stations,'npz':None,'records':records}
+	
+	try:
+		np.savez(fclk + INDEX_EXTENSION,size=st.st_size,mtime=st.st_mtime_ns,stations=stations,
+			**{'r{:d}'.format(i):records[i] for i in records})
+		ottp.Debug('Wrote index {} ({:d} stations, {:d} records)'.format(fclk + INDEX_EXTENSION,len(stations),len(matches)))
+	except Exception as e: # eg no write permission, but we can still use the index
+		ottp.Debug('Unable to write index for {} ({})'.format(fclk,e))
+	return index
+
+# ------------------------------------------
+def LoadIndex(fclk):
+	# Returns the index for the CLK file, building it if necessary
+	# The records of each station are only read from the index file when they're needed (see StationRecords)
+	if fclk in clkIndexes:
+		return clkIndexes[fclk]
+	fidx = fclk + INDEX_EXTENSION
+	index = None
+	if os.path.exists(fidx):
+		try:
+			npz = np.load(fidx) # this doesn't read the members
+			index = {'size':int(npz['size']),'mtime':int(npz['mtime']),'stations':npz['stations'],'npz':npz,'records':{}}
+			st = os.stat(fclk)
+			if len(index['stations']) and not('r0' in npz.files): # made by an older version
+				ottp.Debug('{} is in an old format'.format(fidx))
+				npz.close()
+				index = None
+			elif not(index['size'] == st.st_size and index['mtime'] == st.st_mtime_ns):
+				ottp.Debug('{} is stale'.format(fidx))
+				npz.close()
+				index = None
+		except Exception as e:
+			ottp.Debug('Unable to read {} ({})'.format(fidx,e))
+			index = None
+	if index is None:
+		index = BuildIndex(fclk)
+	clkIndexes[fclk] = index
+	return index
+
+# ------------------------------------------
+def StationRecords(index,i):
+	# Returns the byte ranges of the records of station i, reading them from the index file if need be
+	if not(i in index['records']):
+		index['records'][i] = index['npz']['r{:d}'.format(i)]
+	return index['records'][i]
+
+# ------------------------------------------
+def IndexedCLK(fclk,stamatch):
+	# Returns the station's AR records from an uncompressed CLK file, using the station index
+	# Station names are matched as a prefix, as for the line by line match
+	index = LoadIndex(fclk)
+	staIDs = [i for i,s in enumerate(index['stations']) if s.startswith(stamatch)]
+	ranges = np.zeros((0,2),dtype=np.int64)
+	if staIDs:
+		ranges = np.concatenate([StationRecords(index,i) for i in staIDs])
+	if len(staIDs) > 1: # back into file order
+		ranges = ranges[np.argsort(ranges[:,0],kind='stable')]
+	ottp.Debug('{}: {:d} records for {}'.format(fclk,len(ranges),stamatch))
+	recs = []
+	with open(fclk,'rb') as fin: # read just the records, rather than mapping the file, which would touch every page
+		fd = fin.fileno()
+		for start,stop in ranges.tolist():
+			recs.append(os.pread(fd,stop - start,start).decode())
+	return recs
+
+# ------------------------------------------
+def ReadCLK(fclk,stamatch,useIndex = False):
+	# Returns a list of [mjd,tod,clock] for the station, with the clock value as the string in the file
+	# TOD keeps any fractional seconds
+	dclk = []
+	
+	if fclk.endswith(tuple(COMPRESSION_EXTENSIONS)): # have to stream these
+		recs = []
+		fin,proc = OpenCLK(fclk)
+		stastr = 'AR '+ stamatch
+		for l in fin:
+			if stastr in l:
+				recs.append(l)
+		fin.close()
+		if proc:
+			if proc.wait():
+				ottp.Debug('Failed to decompress {}'.format(fclk))
+	elif useIndex:
+		recs = IndexedCLK(fclk,stamatch)
+	else:
+		recs = FilterCLK(fclk,stamatch)
+		
+	for l in recs:
+		data = l.split()
+		tod = int(data[5])*3600 + int(data[6])*60 + float(data[7]) 
+		dt = datetime.datetime(int(data[2]), int(data[3]), int(data[4]),tzinfo = datetime.timezone.utc)
+		mjd = int(dt.timestamp()/86400) + 40587;
+		dclk.append([mjd,tod,data[9]])
+		
+	ottp.Debug('--->{} has {} points'.format(fclk,len(dclk)))
+	return dclk
+
+# ------------------------------------------
+def MatchCLK(dclk1,dclk2):
+	# Difference the two clocks, lining up the time stamps
+	# TOD is truncated to an integer number of seconds
+	# Returns a list of [mjd,tod,clock1,clock2]
+	matched = []
+	i = 0
+	j = 0
+	lenclk1 = len(dclk1)
+	lenclk2 = len(dclk2)
+	
+	while i < lenclk1 and j < lenclk2:
+		
+		mjd1 = dclk1[i][0]
+		tod1 = int(dclk1[i][1])
+		mjd2 = dclk2[j][0]
+		tod2 = int(dclk2[j][1])
+		
+		if (mjd1 == mjd2 and tod1 == tod2): # ding! ding! It's a Perfect Match!!
+			matched.append([mjd1,tod1,dclk1[i][2],dclk2[j][2]])
+			i += 1
+			j += 1
+			continue
+		
+		# Timestamps do not match
+		# So test MJD first    
+		if (mjd2 > mjd1):
+			i += 1
+			continue
+		elif (mjd2 < mjd1):
+			j += 1
+			continue
+		
+		# MJDs must match so test TOD
+		if (tod2 > tod1):
+			i += 1
+			continue
+		elif (tod2 < tod1):
+			j += 1
+			continue
+			
+	return matched
+
+# ------------------------------------------
+def MatchCLKInterpolated(dclk1,dclk2,interpolated,maxGap):
+	# Lines up the two clocks to sub-second resolution, linearly interpolating one clock onto 
+	# the time stamps of the other. Interpolation is only done when the bracketing points are no more 
+	# than maxGap seconds apart.
+	# interpolated is the clock (1 or 2) to interpolate
+	# Returns a list of [mjd,tod,clock1,clock2], with the clocks as floats
+	
+	if not(dclk1) or not(dclk2):
+		return []
+	
+	if interpolated == 1: # interpolate onto the time stamps of the other clock
+		dref,dint = dclk2,dclk1
+	else:
+		dref,dint = dclk1,dclk2
+		
+	mjd0 = dref[0][0] # time is relative to this to preserve precision
+	tref = np.array([(d[0] - mjd0)*86400 + d[1] for d in dref])
+	tint = np.array([(d[0] - mjd0)*86400 + d[1] for d in dint])
+	xref = np.array([d[2] for d in dref],dtype=float)
+	xint = np.array([d[2] for d in dint],dtype=float)
+	
+	order = np.argsort(tint,kind='stable')
+	tint = tint[order]
+	xint = xint[order]
+	
+	# Index of the first point at or after each reference time stamp
+	idx = np.searchsorted(tint,tref - MATCH_TOLERANCE,side='left')
+	hi = np.minimum(idx,len(tint) - 1)
+	lo = np.maximum(idx - 1,0)
+	
+	exact = np.abs(tint[hi] - tref) <= MATCH_TOLERANCE
+	bracketed = (idx > 0) & (idx < len(tint)) & ((tint[hi] - tint[lo]) <= maxGap) & (tint[hi] > tint[lo])
+	
+	with np.errstate(divide='ignore',invalid='ignore'):
+		frac = (tref - tint[lo])/(tint[hi] - tint[lo])
+		x = np.where(exact,xint[hi],xint[lo] + frac*(xint[hi] - xint[lo]))
+	ok = exact | bracketed
+	
+	ottp.Debug('--->{:d} exact matches, {:d} interpolated'.format(int(np.count_nonzero(exact)),int(np.count_nonzero(ok & ~exact))))
+	
+	matched = []
+	for k in np.nonzero(ok)[0]:
+		if interpolated == 1:
+			matched.append([dref[k][0],dref[k][1],x[k],xref[k]])
+		else:
+			matched.append([dref[k][0],dref[k][1],xref[k],x[k]])
+	return matched
+
+# ------------------------------------------
+def FormatRecord(mjd,tod,clk1,clk2,cleaned = None,flags = None):
+	# TOD is written as an integer unless it has been kept to sub-second resolution
+	# Clocks are written as read from the CLK file, unless they have been modified
+	# If the data have been screened, the cleaned difference and the flags are appended
+	if isinstance(tod,(int,np.integer)):
+		todstr = '{:d}'.format(tod)
+	else:
+		todstr = '{:.3f}'.format(tod)
+	if not(isinstance(clk1,str)):
+		clk1 = '{:.12e}'.format(clk1)
+	if not(isinstance(clk2,str)):
+		clk2 = '{:.12e}'.format(clk2)
+	if flags is None:
+		return '{:d} {} {} {} {:.12e}\n'.format(mjd,todstr,clk1,clk2,float(clk1)-float(clk2))
+	return '{:d} {} {} {} {:.12e} {:.12e} {:d}\n'.format(mjd,todstr,clk1,clk2,float(clk1)-float(clk2),cleaned,flags)
+
+# ------------------------------------------
+def MADSigma(x):
+	# Robust estimate of the standard deviation
+	return 1.4826*np.median(np.abs(x - np.median(x)))
+
+# ------------------------------------------
+def RollingMedian(x,w):
+	# Centred rolling median over w (odd) points
+	# The ends are padded with an odd reflection, which preserves a linear trend
+	if len(x) < 2:
+		return x.copy()
+	half = w//2
+	xp = np.pad(x,half,mode='reflect',reflect_type='odd')
+	med = np.empty(len(x))
+	for c in range(0,len(x),SCREEN_CHUNK): # blocks, because the window view is copied by median()
+		n = min(SCREEN_CHUNK,len(x) - c)
+		med[c:c+n] = np.median(np.lib.stride_tricks.sliding_window_view(xp[c:c+n+w-1],w),axis=1)
+	return med
+
+# ------------------------------------------
+def ScreenCLKDiff(t,x,nSigma):
+	# Flags gaps, phase steps and outliers in the clock difference x, with t in seconds
+	# Returns the cleaned difference, with phase steps removed and outliers set to NaN, and the flags
+	flags = np.zeros(len(x),dtype=int)
+	cleaned = x.copy()
+	if len(x) < 3:
+		return cleaned,flags
+	
+	dt = np.diff(t)
+	interval = np.median(dt[dt > 0])
+	flags[1:][dt > GAP_FACTOR*interval] |= FLAG_GAP
+	
+	# Remove the clock rate, so that what's left is dominated by noise
+	# (otherwise the rolling median just picks out a neighbouring point)
+	dx = np.diff(x)
+	rate = np.median(dx[dt > 0]/dt[dt > 0])
+	y = x - rate*(t - t[0])
+	
+	# Phase steps: candidates are big first differences, confirmed by comparing the medians 
+	# of the points either side, so that noise and single outliers are not mistaken for steps
+	steps = np.zeros(len(x))
+	d = np.diff(y)
+	sig = MADSigma(d)
+	if sig > 0:
+		cand = np.nonzero(np.abs(d - np.median(d)) > nSigma*sig)[0] # step is between cand and cand + 1
+		h = SCREEN_WINDOW//2
+		before = np.clip(cand[:,None] + np.arange(-h + 1,1),0,len(y) - 1)
+		after  = np.clip(cand[:,None] + np.arange(1,h + 1),0,len(y) - 1)
+		est = np.median(y[after],axis=1) - np.median(y[before],axis=1)
+		ok = np.abs(est) > nSigma*1.2533*sig/np.sqrt(h) # 1.2533 for the noise of a median
+		steps[cand[ok] + 1] = est[ok]
+		flags[cand[ok] + 1] |= FLAG_STEP
+	steps = np.cumsum(steps)
+	y -= steps
+	cleaned -= steps
+	
+	# Outliers are tested for in the residuals from the rolling median
+	r = y - RollingMedian(y,SCREEN_WINDOW)
+	sig = MADSigma(r)
+	if sig > 0:
+		outlier = np.abs(r - np.median(r)) > nSigma*sig
+		flags[outlier] |= FLAG_OUTLIER
+		cleaned[outlier] = np.nan
+		
+	return cleaned,flags
+
+# ------------------------------------------
+def ScreenedRecords(data,nSigma):
+	# Screens the difference of the matched clocks in data, a list of [mjd,tod,clock1,clock2,...] 
+	# Returns the output lines and the number of gaps, phase steps and outliers
+	if not(data):
+		return [],0,0,0
+	mjd = np.array([d[0] for d in data],dtype=int)
+	tod = np.array([d[1] for d in data],dtype=float)
+	diff = np.array([float(d[2]) - float(d[3]) for d in data])
+	t = (mjd - mjd[0])*86400.0 + tod
+	cleaned,flags = ScreenCLKDiff(t,diff,nSigma)
+	lines = [FormatRecord(d[0],d[1],d[2],d[3],cleaned[k],flags[k]) for k,d in enumerate(data)]
+	return (lines,int(np.count_nonzero(flags & FLAG_GAP)),int(np.count_nonzero(flags & FLAG_STEP)),
+		int(np.count_nonzero(flags & FLAG_OUTLIER)))
+
+# ------------------------------------------
+def LoadState(fstate):
+	# The state of an incremental difference file is saved as JSON
+	state = {'options':'','last mjd':None,'files':{},'rows':{}}
+	if os.path.exists(fstate):
+		try:
+			with open(fstate,'r') as fin:
+				state = json.load(fin)
+		except Exception as e:
+			ottp.Debug('Unable to read {} ({}) - starting afresh'.format(fstate,e))
+	return state
+
+# ------------------------------------------
+def SaveState(fstate,state):
+	tmp = fstate + '.tmp'
+	with open(tmp,'w') as fout:
+		json.dump(state,fout,indent=1)
+	os.replace(tmp,fstate)
+
+# ------------------------------------------
+def UpdateDiffFile(fdiff,newRows,rowCounts):
+	# newRows is a dictionary of lists of output lines, keyed by the MJD of each (re)processed file (arc)
+	# The difference file is the rows of each arc in turn, as for a full run, and rowCounts (from the state)
+	# is the number of rows each arc contributed, keyed by the arc's MJD as a string. The rows of a 
+	# reprocessed arc replace exactly the rows it contributed before: rows can't be matched by their MJD,
+	# since a file can have points in the next day too (eg a daily file ending with 00:00 of the next day)
+	# rowCounts is updated
+	# Returns the number of lines written
+	
+	if not(newRows):
+		return 0
+	
+	arcs = sorted(newRows.keys())
+	nNew = sum([len(newRows[m]) for m in arcs])
+	oldArcs = sorted([int(m) for m in rowCounts])
+	
+	if not(oldArcs) or oldArcs[-1] < arcs[0]: # the usual case, so just append
+		with open(fdiff,'a') as fout:
+			for m in arcs:
+				fout.writelines(newRows[m])
+				rowCounts[str(m)] = len(newRows[m])
+		ottp.Debug('Appended {:d} lines to {}'.format(nNew,fdiff))
+		return nNew
+	
+	# Otherwise, the rows of some arcs are replaced or new arcs are inserted
+	with open(fdiff,'r') as fin:
+		lines = fin.readlines()
+	if not(len(lines) == sum(rowCounts.values())):
+		ottp.ErrorExit('{} does not match its state - delete it to rebuild it'.format(fdiff))
+	blocks = {}
+	n = 0
+	for m in oldArcs:
+		blocks[m] = lines[n:n + rowCounts[str(m)]]
+		n += rowCounts[str(m)]
+	nKept = sum([len(blocks[m]) for m in oldArcs if not(m in newRows)])
+	for m in arcs:
+		blocks[m] = newRows[m]
+		rowCounts[str(m)] = len(newRows[m])
+	
+	tmp = fdiff + '.tmp'
+	with open(tmp,'w') as fout:
+		for m in sorted(blocks.keys()):
+			fout.writelines(blocks[m])
+	os.replace(tmp,fdiff)
+	ottp.Debug('Rewrote {} ({:d} lines kept, {:d} new)'.format(fdiff,nKept,nNew))
+	return nNew
+
+# ------------------------------------------
+def StitchArcs(t,x,arc):
+	# Removes the offset jumps at the boundaries between arcs (ie CLK files)
+	# t is the time in days, x the clock and arc labels the arc each point came from
+	# Points must be ordered by arc.
+	# Returns the corrected clock, the index of the first point after each boundary, 
+	# the jumps, and the number of overlapping points used to estimate each jump
+	
+	# Renumber the arcs 0,1,2 ... since arcs with no data are skipped
+	arcs,narc = np.unique(arc,return_inverse = True)
+	nArcs  = len(arcs)
+	nBoundaries = nArcs - 1
+	if nBoundaries < 1:
+		return x.copy(),np.zeros(0,dtype=int),np.zeros(0),np.zeros(0,dtype=int)
+	
+	first = np.searchsorted(narc,np.arange(nArcs),side='left') # first point in each arc
+	last  = np.searchsorted(narc,np.arange(nArcs),side='right') - 1 # last point in each arc
+	
+	# Overlapping samples: sort on (time,arc) so that a point and its twin in the next arc are neighbours
+	order = np.lexsort((narc,t))
+	ts = t[order]
+	arcsorted = narc[order]
+	twins = np.nonzero((ts[1:] == ts[:-1]) & (arcsorted[1:] == arcsorted[:-1] + 1))[0]
+	bnd = arcsorted[twins] # boundary index is the index of the earlier arc
+	dx  = x[order[twins + 1]] - x[order[twins]]
+	nOverlap = np.bincount(bnd,minlength=nBoundaries)[:nBoundaries]
+	overlapSum = np.bincount(bnd,weights=dx,minlength=nBoundaries)[:nBoundaries]
+	
+	# Adjacent samples: extrapolate each arc to the midpoint of the gap between them, using the rate
+	# estimated from the points nearest the boundary
+	e = last[:-1]  # end of the earlier arc
+	b = first[1:]  # start of the later arc
+	e0 = np.maximum(e - STITCH_SLOPE_PTS,first[:-1])
+	b1 = np.minimum(b + STITCH_SLOPE_PTS,last[1:])
+	with np.errstate(divide='ignore',invalid='ignore'):
+		slopePrev = np.where(e > e0,(x[e] - x[e0])/(t[e] - t[e0]),0.0)
+		slopeNext = np.where(b1 > b,(x[b1] - x[b])/(t[b1] - t[b]),0.0)
+	slopePrev = np.where(np.isfinite(slopePrev),slopePrev,0.0)
+	slopeNext = np.where(np.isfinite(slopeNext),slopeNext,0.0)
+	tmid = 0.5*(t[e] + t[b])
+	adjacent = (x[b] - slopeNext*(t[b] - tmid)) - (x[e] + slopePrev*(tmid - t[e]))
+	
+	jumps = np.where(nOverlap > 0,overlapSum/np.maximum(nOverlap,1),adjacent)
+	
+	offsets = np.concatenate(([0.0],np.cumsum(jumps)))
+	return x - offsets[narc],b,jumps,nOverlap
 
 examples = 'Usage examples:\n'
 examples += '(1) Difference 7 day files generated using CSRS\n'
@@ -51,8 +537,18 @@ examples += 'otherwise, specify the file name as a template,\n'
 examples += 'Templates are recognized from patterns in the name like YYDDD,YYYYDDD,DDD\n'
 examples += 'eg SYDN24273.clk -> SYDNYYDDD.clk\n'
 examples += 'Note that files with multiple stations can also be parsed since sta1 and sta2 can be used to extract a particular station\n'
+examples += 'If a file is not found, compressed versions (.gz and .Z) are tried, and these are decompressed on the fly\n'
+examples += 'When repeatedly extracting stations from large multi-station files, use --index\n'
+examples += 'With --screen, two columns are added to the output: the difference with phase steps removed and outliers\n'
+examples += 'set to NaN, and flags (OR\'ed) 1 = outlier, 2 = phase step since the previous point, 4 = gap since the previous point\n'
 examples += '(2) Extract two clocks SYDN and USN7 from the IGS CLK file IGS2R03FIN_20191990000_01D_30S_CLK.CLK\n'
 examples += 'diffrnxclk.py --sta1match SYDN --sta2match USN7 IGS0OPSRAP_YYYYDDD0000_01D_05M_CLK.CLK IGS0OPSRAP_YYYYDDD0000_01D_05M_CLK.CLK ~/igs/rapid/ ~/igs/rapid/ ./ 60589 60589\n'
+examples += '(3) Difference a 30 s PPP clock against a 5 minute IGS clock, interpolating the IGS clock\n'
+examples += '    diffrnxclk.py --interpolate 2 --sta2match SYDN SYDNYYDDD.clk IGS0OPSRAP_YYYYDDD0000_01D_05M_CLK.CLK ./sydn ~/igs/rapid ./clkdiffs 60589 60589\n'
+examples += '(4) Difference a month of daily Ginan files, removing the day boundary jumps\n'
+examples += '    diffrnxclk.py --stitch SYDNYYDDD.clk PTBBYYDDD.clk ./sydn ./ptbb ./clkdiffs 60539 60568\n'
+examples += '(5) Maintain ./clkdiffs/SYDN.PTBB.diff.dat from a cron job, processing only new or changed files\n'
+examples += '    diffrnxclk.py --incremental SYDNYYDDD.clk PTBBYYDDD.clk ./sydn ./ptbb ./clkdiffs 60539 60600\n'
 
 parser = argparse.ArgumentParser(description='Differences RINEX clock files',
 	formatter_class=argparse.RawDescriptionHelpFormatter,epilog = examples)
@@ -70,6 +566,13 @@ parser.add_argument('--debug','-d',help='debug (to stderr)',action='store_true')
 parser.add_argument('--version','-v',action='version',version = os.path.basename(sys.argv[0])+ ' ' + VERSION + '\n' + 'Written by ' + AUTHORS)
 parser.add_argument('--sta1match',help='station 1 name to match inside the RINEX clk file (otherwise deduced from file name)\n')
 parser.add_argument('--sta2match',help='station 2 name to match inside the RINEX clk file (otherwise deduced from file name)\n')
+parser.add_argument('--interpolate',help='match time stamps to sub-second resolution, linearly interpolating the given station (1 or 2) onto the time stamps of the other',type=int,choices=[1,2])
+parser.add_argument('--maxgap',help='maximum gap in seconds between points used for interpolation (default 300)',default='300')
+parser.add_argument('--stitch',help='remove the offset jumps at the boundaries between files, writing the jumps to STA1.STA2.START.STOP.jumps.dat',action='store_true')
+parser.add_argument('--screen',help='flag gaps, phase steps and outliers, adding the cleaned difference and the flags to the output',action='store_true')
+parser.add_argument('--nsigma',help='threshold for phase steps and outliers, as a multiple of the robust standard deviation (default 5)',default='5')
+parser.add_argument('--index',help='use (building if necessary) a station index for each uncompressed CLK file, saved as FILE.idx.npz',action='store_true')
+parser.add_argument('--incremental','-i',help='maintain STA1.STA2.diff.dat, processing only new or changed files (state is kept in STA1.STA2.diff.state)',action='store_true')
 
 args = parser.parse_args()
 
@@ -84,6 +587,13 @@ nDays = 1 # expected step in file name time tag
 if args.days:
 	nDays = int(args.days)
 
+interpolate = args.interpolate
+maxGap = float(args.maxgap)
+nSigma = float(args.nsigma)
+
+if args.stitch and args.incremental:
+	ottp.ErrorExit('--stitch and --incremental cannot be used together')
+
 # Set the station name to match
 sta1match = sta1
 sta2match = sta2
@@ -102,16 +612,28 @@ if args.sta1match:
 if args.sta2match:
 	sta2match = args.sta2match
 		
-fdiff = os.path.join(args.outdir,'{}.{}.{:d}.{:d}.diff.dat'.format(sta1match,sta2match,startMJD,stopMJD))
-fout  = open(fdiff,'w')
+if args.incremental:
+	fdiff  = os.path.join(args.outdir,'{}.{}.diff.dat'.format(sta1match,sta2match))
+	fstate = os.path.join(args.outdir,'{}.{}.diff.state'.format(sta1match,sta2match))
+	state = LoadState(fstate)
+	# If the processing options have changed, then everything has to be redone
+	options = 'days={:d} interpolate={} maxgap={:g} screen={} nsigma={:g}'.format(nDays,interpolate,maxGap,args.screen,nSigma)
+	if not(state['options'] == options) or not('rows' in state) or not(os.path.exists(fdiff)):
+		if state['files']:
+			ottp.Debug('Processing options have changed, or the state is from an older version - reprocessing')
+		if os.path.exists(fdiff):
+			os.unlink(fdiff)
+		state = {'options':options,'last mjd':None,'files':{},'rows':{}}
+	newRows = {} # output lines, keyed by file MJD
+else:
+	fdiff = os.path.join(args.outdir,'{}.{}.{:d}.{:d}.diff.dat'.format(sta1match,sta2match,startMJD,stopMJD))
+	fout  = open(fdiff,'w')
 cnt = 0
+arcData = [] # accumulates [mjd,tod,clock1,clock2,arc] when stitching or screening
 
 
 for m in range(startMJD,stopMJD+1,nDays):
 	
-	dclk1 = []
-	dclk2 = []
-
 	yyyy,doy,mon = ottp.MJDtoYYYYDOY(m)
 	yy = yyyy % 100
 	
@@ -129,8 +651,8 @@ for m in range(startMJD,stopMJD+1,nDays):
 	else: # Bernese style
 		fclk1 = os.path.join(args.sta1dir,'PPP{:02d}{:03d}{}.CLK'.format(yy,doy, sta1))
 	
-	if (not(os.path.exists(fclk1)) or (os.path.getsize(fclk1) == 0)):
-		ottp.Debug('{} is  missing/empty'.format(fclk1))
+	fclk1 = FindCLK(fclk1)
+	if not(fclk1):
 		continue
 	
 	if ('YYYYDDD' in sta2): 
@@ -147,76 +669,88 @@ for m in range(startMJD,stopMJD+1,nDays):
 	else:
 		fclk2 = os.path.join(args.sta2dir,'PPP{:02d}{:03d}{}.CLK'.format(yy,doy, sta2))
 
-	if (not(os.path.exists(fclk2)) or (os.path.getsize(fclk2) == 0)):
-		ottp.Debug('{} is  missing/empty'.format(fclk2))
+	fclk2 = FindCLK(fclk2)
+	if not(fclk2):
 		continue
 	
-	# Read the first station 
-	
-	fin = open(fclk1,'r')
-	stastr = 'AR '+ sta1match
-	for l in fin:
-		if stastr in l:
-			data = l.split()
-			tod = int(data[5])*3600 + int(data[6])*60 + int(float(data[7])) 
-			dt = datetime.datetime(int(data[2]), int(data[3]), int(data[4]),tzinfo = datetime.timezone.utc)
-			mjd = int(dt.timestamp()/86400) + 40587;
-			dclk1.append([mjd,tod,data[9]])
-	fin.close()
-	ottp.Debug('--->{} has {} points'.format(fclk1,len(dclk1)))
-	
-	# Read the second station
-	
-	fin = open(fclk2,'r')
-	stastr = 'AR '+ sta2match
-	for l in fin:
-		if stastr in l:
-			data = l.split()
-			tod = int(data[5])*3600 + int(data[6])*60 + int(float(data[7])) 
-			dt = datetime.datetime(int(data[2]), int(data[3]), int(data[4]),tzinfo = datetime.timezone.utc)
-			mjd = int(dt.timestamp()/86400) + 40587;
-			dclk2.append([mjd,tod,data[9]])
-	fin.close()
-	ottp.Debug('--->{} has {} points'.format(fclk2,len(dclk2)))
+	if args.incremental:
+		sources = [fclk1,os.path.getmtime(fclk1),fclk2,os.path.getmtime(fclk2)]
+		if state['files'].get(str(m)) == sources:
+			ottp.Debug('{:d} is unchanged - skipping'.format(m))
+			continue
+		
+	dclk1 = ReadCLK(fclk1,sta1match,args.index)
+	dclk2 = ReadCLK(fclk2,sta2match,args.index)
 	
-	# Difference the two clocks, lining up the time stamps
+	if args.interpolate:
+		matched = MatchCLKInterpolated(dclk1,dclk2,interpolate,maxGap)
+	else:
+		matched = MatchCLK(dclk1,dclk2)
 	
-	i = 0
-	j = 0
-	lenclk1 = len(dclk1)
-	lenclk2 = len(dclk2)
+	if args.incremental:
+		if args.screen: # each file is screened on its own
+			newRows[m],nGaps,nSteps,nOutliers = ScreenedRecords(matched,nSigma)
+			ottp.Debug('{:d}: {:d} gaps, {:d} phase steps, {:d} outliers'.format(m,nGaps,nSteps,nOutliers))
+		else:
+			newRows[m] = [FormatRecord(d[0],d[1],d[2],d[3]) for d in matched]
+		state['files'][str(m)] = sources
+		if state['last mjd'] is None or m > state['last mjd']:
+			state['last mjd'] = m
+		continue
 	
-	while i < lenclk1 and j < lenclk2:
-		
-		mjd1 = dclk1[i][0]
-		tod1 = dclk1[i][1]
-		mjd2 = dclk2[j][0]
-		tod2 = dclk2[j][1]
-		
-		if (mjd1 == mjd2 and tod1 == tod2): # ding! ding! It's a Perfect Match!!
-			fout.write('{:d} {:d} {} {} {:.12e}\n'.format(dclk1[i][0],dclk1[i][1],dclk1[i][2],dclk2[j][2],float(dclk1[i][2])-float(dclk2[j][2])))
-			cnt += 1
-			i += 1
-			j += 1
-			continue
-		
-		# Timestamps do not match
-		# So test MJD first    
-		if (mjd2 > mjd1):
-			i += 1
-			continue
-		elif (mjd2 < mjd1):
-			j += 1
-			continue
+	if args.stitch or args.screen: # need all of the data first
+		for d in matched:
+			d.append(m)
+		arcData += matched
+		continue
 		
-		# MJDs must match so test TOD
-		if (tod2 > tod1):
-			i += 1
-			continue
-		elif (tod2 < tod1):
-			j += 1
-			continue
+	for d in matched:
+		fout.write(FormatRecord(d[0],d[1],d[2],d[3]))
+	cnt += len(matched)
+
+if args.incremental:
+	cnt = UpdateDiffFile(fdiff,newRows,state['rows'])
+	SaveState(fstate,state)
+
+if args.stitch and arcData:
+	
+	mjd = np.array([d[0] for d in arcData],dtype=int)
+	tod = np.array([d[1] for d in arcData]) # int, unless interpolating
+	clk1 = np.array([d[2] for d in arcData],dtype=float)
+	clk2 = np.array([d[3] for d in arcData],dtype=float)
+	arc  = np.array([d[4] for d in arcData],dtype=int)
+	t = mjd + tod/86400.0
+	
+	clk1,bnd,jumps1,nOverlap1 = StitchArcs(t,clk1,arc)
+	clk2,bnd,jumps2,nOverlap2 = StitchArcs(t,clk2,arc)
+	
+	for k,d in enumerate(arcData):
+		d[2] = clk1[k]
+		d[3] = clk2[k]
+	
+	# Report the jumps
+	fjumps = os.path.join(args.outdir,'{}.{}.{:d}.{:d}.jumps.dat'.format(sta1match,sta2match,startMJD,stopMJD))
+	fj = open(fjumps,'w')
+	for k in range(0,len(bnd)):
+		fj.write('{:d} {:g} {:.12e} {:.12e} {:d} {:d}\n'.format(mjd[bnd[k]],tod[bnd[k]],jumps1[k],jumps2[k],nOverlap1[k],nOverlap2[k]))
+	fj.close()
+	
+	ottp.Debug('{:d} arc boundaries stitched (jumps in {})'.format(len(bnd),fjumps))
+	if len(bnd):
+		for sta,jumps in [[sta1match,jumps1],[sta2match,jumps2]]:
+			ottp.Debug('{}: mean jump {:.3e} s, rms {:.3e} s, max |jump| {:.3e} s'.format(sta,np.mean(jumps),
+				np.sqrt(np.mean(jumps**2)),np.max(np.abs(jumps))))
+
+if args.screen and arcData:
+	lines,nGaps,nSteps,nOutliers = ScreenedRecords(arcData,nSigma)
+	fout.writelines(lines)
+	ottp.Debug('{:d} gaps, {:d} phase steps, {:d} outliers flagged'.format(nGaps,nSteps,nOutliers))
+elif arcData:
+	for d in arcData:
+		fout.write(FormatRecord(d[0],d[1],d[2],d[3]))
+cnt += len(arcData)
 
 ottp.Debug('--->{:d} matched points in {}'.format(cnt,fdiff))
 
-fout.close()
+if not(args.incremental):
+	fout.close()
@@ -29,13 +29,28 @@
 
 import argparse
 import calendar
-import magic
+import concurrent.futures
+import email.utils
+import gzip
+import hashlib
+import http.cookiejar
+import json
 import os
 import re
+import shlex
+import signal
+import shutil
+import sqlite3
+import subprocess
 import sys
+import tempfile
+import threading
 import time
+import urllib.parse
 import requests
 import pycurl
+import urllib3
+import zlib
 
 # A fudge
 sys.path.append("/usr/local/lib/python3.6/site-packages")  # Ubuntu 18.04
@@ -47,9 +62,66 @@ try:
 except ImportError:
 	sys.exit('ERROR: Must install ottplib\n eg openttp/software/system/installsys.py -i ottplib')
 
-VERSION = "1.0.1"
+VERSION = "1.1.0"
 AUTHORS = "Michael Wouters"
 
+MAX_ATTEMPTS = 4    # number of attempts at a download, resuming where the previous attempt stopped
+RETRY_DELAY  = 5    # seconds between attempts
+CHUNK_SIZE   = 1048576 # bytes read and written at a time
+PART_EXT     = '.part' # files are downloaded to destination + PART_EXT and renamed when complete and valid
+INFLATED_EXT = '.inflated' # decompressed files being staged
+LISTING_TTL  = 3600 # seconds that a cached directory listing is used for
+
+# After a failed download, the next attempt is deferred, doubling the wait each time
+BACKOFF_START  = 3600 # seconds
+BACKOFF_MAX    = 7*86400 
+GIVE_UP_ATTEMPTS = 12 # after this many, a file that's still missing is treated as never going to turn up
+
+# The store is shared by a group of users, so new directories are group writable and setgid, so that
+# what's in them belongs to the group
+STORE_DIR_MODE = 0o2775
+STORE_DB_MODE  = 0o664
+
+# Authentication cookies (eg from the Earthdata login for CDDIS) are kept between runs
+COOKIE_TTL = 8*3600 # seconds that a cookie without an expiry time is kept for
+
+# Ranking of mirrors
+PROBE_TIMEOUT = 10 # seconds
+RANK_SIZE     = 1000000 # mirrors are ranked by the expected time to download a file of this many bytes
+MIN_RATE_SIZE = 100000 # downloads smaller than this are not used to estimate throughput
+STATS_WEIGHT  = 0.3 # weight of a new measurement in the running averages
+
+# Watch mode: polling speeds up after something has been downloaded, since products tend to be published together
+POLL_MIN      = 60 # seconds
+POLL_INTERVAL = 900 # default maximum time between polls
+
+# Formats of downloaded files, and the signatures at the start of them
+GZIP         = 'gzip'
+UNIXCOMPRESS = 'compress' # .Z
+SIGNATURES = {GZIP:b'\x1f\x8b',UNIXCOMPRESS:b'\x1f\x9d'}
+COMPRESSION_EXTENSIONS = ['.gz','.Z']
+
+# Checksum manifests published in each directory, in order of preference, and their hash algorithms
+MANIFESTS = [['SHA512SUMS','sha512'],['SHA256SUMS','sha256'],['MD5SUMS','md5']]
+CHECKSUM_MISMATCH = 'checksum mismatch'
+
+# Product tiers
+RAPID = 'rapid'
+FINAL = 'final'
+RAPID_ONLY = 'rapid only' # rapid products, and final products are no longer expected
+FINAL_LATENCY = 12 # days before final products might be published
+FINAL_GIVE_UP = 120 # days after which final products are no longer looked for (final biases are quarterly)
+TIERED_PATHS  = ['products','osb bias','dcb bias'] # paths of the products that come in tiers
+
+# Download status
+DOWNLOADED   = 'downloaded'
+SKIPPED      = 'skipped'
+NOTMODIFIED  = 'not modified'
+MISSING      = 'missing'
+DEFERRED     = 'deferred'
+FAILED       = 'failed'
+NOT_LISTED   = 'not in the directory listing' # the message for a file that is MISSING because it's not in the listing
+
 # RINEX V3 constellation identifiers
 BEIDOU='C'
 GALILEO='E'
@@ -86,31 +158,1115 @@ def GNSStoNavDirectory(gnss):
 		return 'p'
 
 # ---------------------------------------------
-def FetchFile(session,url,destination,magicTag):
-	
-	if url[-1] =='/': # ugly hack to determine if we failed to contrsuct a file name
-		return False
+def FetchFile(session,url,destination,fileFormat,metrics,hostLock):
+	# Returns the download status and a message
+	# Measurements of the transfer are put in metrics
+	# hostLock is the (acquired) semaphore limiting the connections to the host, which is released while waiting to retry
 	
+	conditions = {}
 	if not(args.force):
 		if os.path.isfile(destination):
 			if os.path.getsize(destination):
-				ottp.Debug('File exists! Download skipped, tra-la!')
-				return True
+				if not(args.refresh):
+					ottp.Debug('File exists! Download skipped, tra-la!')
+					return Staged(destination,(SKIPPED,'exists'))
+				conditions = ConditionalHeaders(destination)
+	
+	if store and not(args.force) and not(conditions) and LinkFromStore(url,destination):
+		return Staged(destination,(SKIPPED,'in store'))
+		
+	deferral = Deferral(url)
+	if deferral:
+		ottp.Debug('{} deferred ({})'.format(url,deferral))
+		return (DEFERRED,deferral)
+		
+	if url[-1] =='/': # ugly hack to determine if we failed to contrsuct a file name
+		return (FAILED,'no file name')
+		
+	if not(args.nolistings) and not(RemoteFileExists(session,url)):
+		ottp.Debug('{} is {}'.format(url,NOT_LISTED))
+		return (MISSING,NOT_LISTED)
 		
 	ottp.Debug('Downloading '+ url)
 	ottp.Debug('Destination = ' + destination)
+	
+	# The download goes to a temporary file, which is only moved into place when complete and validated
+	# so that an interrupted download does not leave a truncated file at the destination
+	# If a partial download exists, it is resumed
+	partFile = destination + PART_EXT
+	if args.force and os.path.exists(partFile): # start afresh
+		os.unlink(partFile)
+	
+	# If staging, gzip files are decompressed into the staging directory as they are downloaded
+	inflated = None
+	if stageDir and fileFormat == GZIP:
+		inflated = StagedName(destination) + INFLATED_EXT
+		
+	checksum = None
+	if not(args.nochecksums):
+		checksum = ManifestChecksum(session,url,False)
+		
+	msg = ''
+	response = {} # headers of the response
+	for attempt in range(0,MAX_ATTEMPTS):
+		if attempt > 0:
+			ottp.Debug('Retrying {} ({})'.format(url,msg))
+			hostLock.release() # so that other downloads from the host can go ahead in the meantime
+			try:
+				time.sleep(RETRY_DELAY)
+			finally:
+				hostLock.acquire()
+			if CHECKSUM_MISMATCH in msg: # the file may have been replaced since the manifest was cached
+				checksum = ManifestChecksum(session,url,True)
+		checker = NewChecker(fileFormat,inflated,checksum)
+		metrics['attempts'] = attempt + 1
+		try:
+			status,msg = FetchPart(session,url,partFile,checker,conditions,response,metrics)
+		except (requests.exceptions.RequestException,urllib3.exceptions.HTTPError) as e: # connection dropped etc, so try again
+			status,msg = None,str(e)
+			continue
+		finally:
+			CloseChecker(checker)
+		if status is None: # incomplete, so try again
+			continue
+		break
+	else: # the part file is kept so that the next run can resume from where this one stopped
+		if inflated and os.path.exists(inflated):
+			os.unlink(inflated)
+		return (FAILED,'gave up after {:d} attempts ({})'.format(MAX_ATTEMPTS,msg))
+	
+	if status != DOWNLOADED and inflated and os.path.exists(inflated):
+		os.unlink(inflated)
+		
+	if status in [FAILED,MISSING]: # FetchPart has removed the partial download if it's bad
+		if status == MISSING and os.path.exists(partFile): # no longer of any use
+			os.unlink(partFile)
+		return (status,msg)
+	
+	if status == NOTMODIFIED:
+		return Staged(destination,(NOTMODIFIED,msg))
+	
+	# FetchPart has validated the file
+	if store:
+		AddToStore(partFile,destination,checker['sha256'].hexdigest(),url,response)
+	else:
+		os.replace(partFile,destination)
+	SaveMetadata(destination,url,response.get('ETag'),response.get('Last-Modified'),os.path.getsize(destination))
+	return Staged(destination,(DOWNLOADED,msg),inflated)
+
+# ---------------------------------------------
+def FetchPart(session,url,partFile,checker,conditions,response,metrics):
+	# Downloads url to partFile, resuming from the end of partFile if it exists
+	# The download is validated as it is written, using checker, and abandoned as soon as it is known to be bad
+	# conditions are headers for a conditional request, used if there is nothing to resume
+	# The response headers are copied to response, and measurements of the transfer are added to metrics
+	# Returns the status and a message; the status is None if the download is incomplete and should be resumed
+	# partFile is removed if what has been downloaded is known to be bad, but a partial download is kept
+	# if the response is bad (eg a login page served instead of the rest of the file), so it can be resumed later
+	
+	offset = 0
+	headers = {}
+	if os.path.exists(partFile):
+		offset = os.path.getsize(partFile)
+	if offset > 0:
+		# The checks have to see the whole file, so begin with what we've got
+		with open(partFile,'rb') as fd:
+			for chunk in iter(lambda: fd.read(CHUNK_SIZE),b''):
+				err = CheckChunk(checker,chunk)
+				if err:
+					metrics['validation'] = err
+					os.unlink(partFile)
+					return (None,'bad partial download ({})'.format(err))
+		headers['Range'] = 'bytes={:d}-'.format(offset)
+		ottp.Debug('Resuming {} from byte {:d}'.format(url,offset))
+	else:
+		headers.update(conditions)
+		
+	with session.get(url,headers=headers,stream=True) as r:
+		
+		response.update(r.headers)
+		metrics['http'] = r.status_code
+		if metrics['ttfb'] is None:
+			metrics['ttfb'] = r.elapsed.total_seconds() # until the headers arrived
+		if r.status_code == 304:
+			return (NOTMODIFIED,'HTTP 304')
+		if r.status_code == 416: # range not satisfiable, so the partial file is probably complete
+			err = CheckEnd(checker)
+			metrics['validation'] = err or 'ok'
+			if err:
+				os.unlink(partFile)
+				return (None,'bad partial download ({})'.format(err))
+			return (DOWNLOADED,'HTTP 416 (already complete)')
+		if r.status_code >= 500: # server trouble, so try again
+			return (None,'HTTP {:d}'.format(r.status_code))
+		if r.status_code == 404:
+			return (MISSING,'HTTP 404')
+		if not(r.status_code in [200,206]):
+			return (FAILED,'HTTP {:d}'.format(r.status_code))
+		if 'text/html' in r.headers.get('Content-Type',''): # typically a login page
+			metrics['validation'] = 'got HTML'
+			return (FAILED,'HTTP {:d}, got HTML'.format(r.status_code))
+		
+		if r.status_code == 200: # a fresh download, either because we asked for one or the server ignored the range
+			if offset > 0: # the partial download is only replaced once the new one looks good
+				ResetChecker(checker)
+			offset = 0
+			expected = r.headers.get('Content-Length')
+		else: # Content-Range: bytes start-end/total
+			m = re.match(r'bytes\s+(\d+)-\d+/(\d+|\*)',r.headers.get('Content-Range',''))
+			if not(m) or not(int(m.group(1)) == offset):
+				os.unlink(partFile) # don't know what we've got, so start again
+				return (None,'bad Content-Range')
+			expected = None if m.group(2) == '*' else int(m.group(2)) - offset
+			
+		nBytes = 0
+		fd = None # opened when the first chunk has been checked
+		try:
+			for chunk in r.raw.stream(CHUNK_SIZE,decode_content=False): # the bytes as sent, so that ranges line up
+				err = CheckChunk(checker,chunk)
+				if err: # give up on this straight away
+					metrics['validation'] = err
+					if (fd or r.status_code == 206) and os.path.exists(partFile): # the file is bad, not just the response
+						os.unlink(partFile)
+					return (FAILED,'HTTP {:d}, {}'.format(r.status_code,err))
+				if not(fd):
+					fd = open(partFile,'ab' if offset else 'wb')
+				fd.write(chunk)
+				nBytes += len(chunk)
+				metrics['bytes'] += len(chunk)
+		finally:
+			if fd:
+				fd.close()
+				
+		msg = 'HTTP {:d}, {:d} bytes'.format(r.status_code,offset + nBytes)
+		if expected is not None and nBytes < int(expected):
+			return (None,'{} ({:d} bytes short)'.format(msg,int(expected) - nBytes))
+		
+	err = CheckEnd(checker)
+	metrics['validation'] = err or 'ok'
+	if err == CHECKSUM_MISMATCH: # corrupted in transit perhaps, so start again
+		os.unlink(partFile)
+		return (None,'{}, {}'.format(msg,err))
+	if err:
+		if (nBytes or r.status_code == 206) and os.path.exists(partFile): # otherwise, it's the partial download, untouched
+			os.unlink(partFile)
+		return (FAILED,'{}, {}'.format(msg,err))
+		
+	return (DOWNLOADED,msg)
 
-	r = session.get(url)
-	with open(destination,'wb') as fd:
-		for chunk in r.iter_content(chunk_size=1000):
-			fd.write(chunk)
+# ---------------------------------------------
+def NewChecker(fileFormat,inflated=None,checksum=None):
+	# Returns the state used to validate a file as it is downloaded
+	# If inflated is given, the decompressed gzip file is written to it
+	# checksum is the [algorithm,hex digest] that the file should have, if known
+	checker = {'format':fileFormat,'head':b'','inflater':None,'pending':False,'sink':None,'sha256':hashlib.sha256(),
+		'checksum':checksum,'digest':None}
+	if checksum:
+		checker['digest'] = hashlib.new(checksum[0])
+	if fileFormat == GZIP: # the gzip trailer has the CRC and length, which zlib checks
+		checker['inflater'] = zlib.decompressobj(16 + zlib.MAX_WBITS)
+		if inflated:
+			checker['sink'] = open(inflated,'wb')
+	return checker
 
-	fd.close()
-	if magicTag in magic.from_file(destination):
-		return True
+# ---------------------------------------------
+def ResetChecker(checker):
+	# Starts checking again from the beginning of the file
+	checker['head'] = b''
+	checker['pending'] = False
+	checker['sha256'] = hashlib.sha256()
+	if checker['checksum']:
+		checker['digest'] = hashlib.new(checker['checksum'][0])
+	if checker['inflater']:
+		checker['inflater'] = zlib.decompressobj(16 + zlib.MAX_WBITS)
+	if checker['sink']:
+		checker['sink'].seek(0)
+		checker['sink'].truncate()
+
+# ---------------------------------------------
+def CloseChecker(checker):
+	if checker['sink']:
+		checker['sink'].close()
+
+# ---------------------------------------------
+def CheckChunk(checker,chunk):
+	# Checks the next chunk of a file
+	# Returns an error message, which is empty if all is well so far
+	signature = SIGNATURES[checker['format']]
+	if len(checker['head']) < len(signature):
+		checker['head'] += chunk[:len(signature) - len(checker['head'])]
+		if not(signature.startswith(checker['head'])):
+			if checker['head'].lstrip()[:1] == b'<':
+				return 'got HTML'
+			return 'not {} format'.format(checker['format'])
+	checker['sha256'].update(chunk)
+	if checker['digest']:
+		checker['digest'].update(chunk)
+	if checker['inflater']:
+		try:
+			while chunk:
+				inflater = checker['inflater']
+				data = inflater.decompress(chunk,CHUNK_SIZE) # limit how much is made at a time
+				if checker['sink']:
+					checker['sink'].write(data)
+				if inflater.eof: # there may be another gzip member
+					chunk = inflater.unused_data
+					checker['inflater'] = zlib.decompressobj(16 + zlib.MAX_WBITS)
+					checker['pending'] = False
+				else:
+					chunk = inflater.unconsumed_tail
+					checker['pending'] = True
+		except zlib.error as e:
+			return 'corrupt gzip ({})'.format(e)
+	return ''
+
+# ---------------------------------------------
+def CheckEnd(checker):
+	# Checks that a file is complete
+	# Returns an error message, which is empty if all is well
+	if len(checker['head']) < len(SIGNATURES[checker['format']]):
+		return 'too short'
+	if checker['pending']:
+		return 'truncated gzip'
+	if checker['digest'] and checker['digest'].hexdigest() != checker['checksum'][1]:
+		return CHECKSUM_MISMATCH
+	return ''
+
+# ---------------------------------------------
+def IsHatanaka(fname):
+	# fname is without any compression extension
+	return fname.endswith('.crx') or re.search(r'\.\d{2}d$',fname) is not None
+
+# ---------------------------------------------
+def UncompressedName(destination):
+	# Returns the file name of destination, without any compression extension
+	fname = os.path.basename(destination)
+	for ext in COMPRESSION_EXTENSIONS:
+		if fname.endswith(ext):
+			return fname[:-len(ext)]
+	return fname
+
+# ---------------------------------------------
+def StagedName(destination):
+	# Returns the path of the decompressed copy of destination in the staging directory
+	fname = UncompressedName(destination)
+	if fname.endswith('.crx'):
+		fname = fname[:-4] + '.rnx'
+	elif IsHatanaka(fname): # RINEX V2
+		fname = fname[:-1] + 'o'
+	return os.path.join(stageDir,fname)
+
+# ---------------------------------------------
+def StageFile(destination,inflated=None):
+	# Puts a decompressed copy of destination in the staging directory, unless there's an up to date one already
+	# inflated is destination, already decompressed, if available
+	# Returns an error message, which is empty if all went well
+	staged = StagedName(destination)
+	partFile = staged + PART_EXT
+	if not(inflated):
+		if os.path.exists(staged) and os.path.getmtime(staged) >= os.path.getmtime(destination):
+			return ''
+		inflated = staged + INFLATED_EXT
+		try:
+			with open(inflated,'wb') as fout:
+				if destination.endswith('.Z'): # no support for this in Python
+					subprocess.run(['gzip','-dc',destination],stdout=fout,check=True)
+				elif destination.endswith('.gz'):
+					with gzip.open(destination,'rb') as fin:
+						shutil.copyfileobj(fin,fout,CHUNK_SIZE)
+				else:
+					with open(destination,'rb') as fin:
+						shutil.copyfileobj(fin,fout,CHUNK_SIZE)
+		except (OSError,EOFError,subprocess.CalledProcessError) as e:
+			os.unlink(inflated)
+			return str(e)
+	
+	if IsHatanaka(UncompressedName(destination)):
+		try:
+			with open(inflated,'rb') as fin, open(partFile,'wb') as fout:
+				subprocess.run([args.crx2rnx],stdin=fin,stdout=fout,check=True)
+		except (OSError,subprocess.CalledProcessError) as e:
+			if os.path.exists(partFile):
+				os.unlink(partFile)
+			return 'Hatanaka decompression failed ({})'.format(e)
+		finally:
+			os.unlink(inflated)
 	else:
-		ottp.Debug('Bad download - got ' + magic.from_file(destination))
+		os.replace(inflated,partFile)
+		
+	os.replace(partFile,staged)
+	ottp.Debug('Staged ' + staged)
+	return ''
+
+# ---------------------------------------------
+def Staged(destination,result,inflated=None):
+	# Stages destination, if required, and returns result, amended if staging failed
+	if not(stageDir):
+		return result
+	err = StageFile(destination,inflated)
+	if err:
+		return (FAILED,'{}, but staging failed ({})'.format(result[1],err))
+	return result
+
+# ---------------------------------------------
+def SetStoreMode(path,mode):
+	# Only the owner can change the mode, so whoever created it has already done so
+	try:
+		if os.stat(path).st_uid == os.getuid():
+			os.chmod(path,mode)
+	except OSError as e:
+		ottp.Debug('Unable to set the mode of {} ({})'.format(path,e))
+
+# ---------------------------------------------
+def MakeStoreDir(theDir):
+	# Creates a directory in the store, and any missing parents, with STORE_DIR_MODE (os.makedirs is subject to the umask)
+	if os.path.isdir(theDir):
+		return
+	parent = os.path.dirname(os.path.abspath(theDir))
+	if not(os.path.isdir(parent)):
+		MakeStoreDir(parent)
+	os.makedirs(theDir,exist_ok=True) # someone else may have just made it
+	SetStoreMode(theDir,STORE_DIR_MODE)
+
+# ---------------------------------------------
+def OpenStore(storeDir):
+	# The store holds one copy of each version of a product, shared by everyone on the host
+	# Each version is keyed by the product's name and SHA-256 checksum
+	# Views are the links to the store that have been made in the download directories
+	storeDB = os.path.join(storeDir,'store.db')
+	try:
+		MakeStoreDir(storeDir)
+		MakeStoreDir(os.path.join(storeDir,'objects'))
+		store = sqlite3.connect(storeDB,timeout=60,check_same_thread=False) # access is serialized with storeLock
+		store.execute('CREATE TABLE IF NOT EXISTS objects (name TEXT,sha256 TEXT,size INTEGER,url TEXT,etag TEXT,last_modified TEXT,stored REAL,PRIMARY KEY (name,sha256))')
+		store.execute('CREATE TABLE IF NOT EXISTS views (view TEXT PRIMARY KEY,name TEXT,sha256 TEXT,linked REAL)')
+		store.commit()
+	except (OSError,sqlite3.Error) as e:
+		ottp.ErrorExit('Unable to open the store {} ({})'.format(storeDir,e))
+	SetStoreMode(storeDB,STORE_DB_MODE)
+	return store
+
+# ---------------------------------------------
+def ObjectPath(name,sha256):
+	return os.path.join(storeDir,'objects',name,sha256)
+
+# ---------------------------------------------
+def LinkView(name,sha256,destination):
+	# Links destination to a product in the store, replacing whatever is there
+	obj = ObjectPath(name,sha256)
+	tmpLink = destination + PART_EXT
+	if os.path.lexists(tmpLink):
+		os.unlink(tmpLink)
+	try:
+		if args.symlinks:
+			os.symlink(os.path.abspath(obj),tmpLink)
+		else:
+			os.link(obj,tmpLink)
+	except OSError as e: # hard links don't work across file systems, or to another user's files if protected_hardlinks is set
+		if args.symlinks:
+			raise
+		ottp.Debug('Hard link to {} failed ({}), so using a symbolic link'.format(obj,e))
+		os.symlink(os.path.abspath(obj),tmpLink)
+	try:
+		os.replace(tmpLink,destination)
+	except OSError: # don't leave the link where it would be taken for a partial download
+		os.unlink(tmpLink)
+		raise
+	with storeLock:
+		store.execute('INSERT OR REPLACE INTO views VALUES (?,?,?,?)',(os.path.abspath(destination),name,sha256,time.time()))
+		store.commit()
+
+# ---------------------------------------------
+def LinkFromStore(url,destination):
+	# Links destination to the latest version of the product in the store, if there is one
+	# Returns True if it was linked
+	name = os.path.basename(destination)
+	try:
+		with storeLock:
+			rows = store.execute('SELECT sha256,size,etag,last_modified FROM objects WHERE name=? ORDER BY stored DESC',(name,)).fetchall()
+		for sha256,size,etag,lastModified in rows:
+			if os.path.isfile(ObjectPath(name,sha256)): # it may have been garbage collected
+				LinkView(name,sha256,destination)
+				SaveMetadata(destination,url,etag,lastModified,size)
+				ottp.Debug('Linked {} from the store'.format(destination))
+				return True
+	except (OSError,sqlite3.Error) as e: # eg the store isn't writable by us, so download it instead
+		ottp.Debug('Unable to link {} from the store ({})'.format(destination,e))
+	return False
+
+# ---------------------------------------------
+def AddToStore(partFile,destination,sha256,url,response):
+	# Moves a completed download into the store, unless it's already there, and links destination to it
+	# If the store can't be used (eg it isn't writable by us), destination is a private copy instead
+	name = os.path.basename(destination)
+	obj = ObjectPath(name,sha256)
+	objDir = os.path.dirname(obj)
+	madeDir = False
+	tmpObj = None
+	added = False # by us, to the store
+	recorded = False
+	try:
+		if not(os.path.isfile(obj)): # otherwise someone else got it first, and the download is replaced by the link
+			if not(os.path.isdir(objDir)):
+				MakeStoreDir(objDir)
+				madeDir = True
+			# The store is usually on another file system, so the download is copied next to the object
+			# and renamed, so that no one sees an incomplete object
+			fd,tmpObj = tempfile.mkstemp(dir=objDir,prefix='.' + sha256 + '.')
+			os.close(fd)
+			shutil.copyfile(partFile,tmpObj)
+			os.chmod(tmpObj,0o444) # views are hard links, so the product mustn't be modified in place
+			os.replace(tmpObj,obj)
+			tmpObj = None
+			added = True
+		with storeLock:
+			store.execute('INSERT OR REPLACE INTO objects VALUES (?,?,?,?,?,?,?)',(name,sha256,os.path.getsize(obj),url,
+				response.get('ETag'),response.get('Last-Modified'),time.time()))
+			store.commit()
+		recorded = True
+		LinkView(name,sha256,destination) # this replaces the download
+	except (OSError,sqlite3.Error) as e:
+		ottp.Debug('Unable to add {} to the store ({}), so keeping a private copy'.format(destination,e))
+		with storeLock:
+			store.rollback()
+		# Don't leave anything in the store that isn't recorded there
+		for f in [tmpObj,obj if (added and not(recorded)) else None]:
+			if f and os.path.exists(f):
+				os.unlink(f)
+		if madeDir and not(recorded):
+			try:
+				os.rmdir(objDir)
+			except OSError:
+				pass
+		if not(os.path.exists(partFile)): # it's in the store, but couldn't be linked
+			shutil.copyfile(obj,partFile)
+		os.replace(partFile,destination)
+
+# ---------------------------------------------
+def ViewIsLive(view,obj):
+	# Returns False if the view has definitely gone, or now refers to something other than obj (eg a newer version)
+	# A view that can't be checked (eg it's in someone else's directory that we can't get into) is assumed to be live
+	try:
+		st = os.stat(view) # this follows symbolic links
+	except FileNotFoundError:
+		return False
+	except OSError:
+		return True
+	try:
+		return os.path.samestat(st,os.stat(obj))
+	except FileNotFoundError:
 		return False
+	except OSError:
+		return True
+
+# ---------------------------------------------
+def CollectGarbage():
+	# Removes the products in the store that are no longer linked to from anywhere
+	# A view has gone if it has been deleted or now refers to something else (eg a newer version)
+	with storeLock:
+		views = store.execute('SELECT view,name,sha256 FROM views').fetchall()
+		objects = store.execute('SELECT name,sha256,size FROM objects').fetchall()
+	live = set()
+	for view,name,sha256 in views:
+		if ViewIsLive(view,ObjectPath(name,sha256)):
+			live.add((name,sha256))
+		else:
+			with storeLock:
+				store.execute('DELETE FROM views WHERE view=? AND sha256=?',(view,sha256))
+	nRemoved = 0
+	nBytes = 0
+	for name,sha256,size in objects:
+		if (name,sha256) in live:
+			continue
+		obj = ObjectPath(name,sha256)
+		if os.path.exists(obj):
+			os.unlink(obj)
+			nBytes += size
+		nRemoved += 1
+		ottp.Debug('Removed {} {}'.format(name,sha256))
+		with storeLock:
+			store.execute('DELETE FROM objects WHERE name=? AND sha256=?',(name,sha256))
+		try:
+			os.rmdir(os.path.dirname(obj))
+		except OSError: # other versions remain
+			pass
+	with storeLock:
+		store.commit()
+	print('Removed {:d} of {:d} products from the store ({:d} bytes)'.format(nRemoved,len(objects),nBytes))
+
+# ---------------------------------------------
+def OpenDatabase(dbFile):
+	# The database holds what we know about downloaded files
+	try:
+		if os.path.dirname(dbFile):
+			os.makedirs(os.path.dirname(dbFile),exist_ok=True)
+		db = sqlite3.connect(dbFile,check_same_thread=False) # access is serialized with dbLock
+		db.execute('CREATE TABLE IF NOT EXISTS metadata (destination TEXT PRIMARY KEY,url TEXT,etag TEXT,last_modified TEXT,size INTEGER,fetched REAL)')
+		db.execute('CREATE TABLE IF NOT EXISTS listings (directory TEXT PRIMARY KEY,files TEXT,fetched REAL)')
+		db.execute('CREATE TABLE IF NOT EXISTS manifests (directory TEXT PRIMARY KEY,name TEXT,sums TEXT,fetched REAL)')
+		# The ledger of download attempts
+		db.execute('CREATE TABLE IF NOT EXISTS ledger (url TEXT PRIMARY KEY,status TEXT,message TEXT,attempts INTEGER,permanent INTEGER,first REAL,last REAL,next REAL)')
+		db.execute('CREATE TABLE IF NOT EXISTS tiers (mjd INTEGER PRIMARY KEY,tier TEXT,updated REAL)')
+		db.execute('CREATE TABLE IF NOT EXISTS mirrors (centre TEXT PRIMARY KEY,latency REAL,throughput REAL,successes INTEGER,failures INTEGER,updated REAL)')
+		db.commit()
+	except (OSError,sqlite3.Error) as e:
+		ottp.ErrorExit('Unable to open the database {} ({})'.format(dbFile,e))
+	return db
+
+# ---------------------------------------------
+def GetMetadata(destination):
+	# Returns (etag,last modified,size) or None
+	with dbLock:
+		return db.execute('SELECT etag,last_modified,size FROM metadata WHERE destination=?',(os.path.abspath(destination),)).fetchone()
+
+# ---------------------------------------------
+def SaveMetadata(destination,url,etag,lastModified,size):
+	with dbLock:
+		db.execute('INSERT OR REPLACE INTO metadata VALUES (?,?,?,?,?,?)',(os.path.abspath(destination),url,etag,lastModified,size,time.time()))
+		db.commit()
+
+# ---------------------------------------------
+def ConditionalHeaders(destination):
+	# Returns the headers for a conditional request for an existing file
+	# If we don't know anything about the file, or it has changed since it was downloaded,
+	# then the file's modification time is used
+	meta = GetMetadata(destination)
+	if meta and meta[2] == os.path.getsize(destination):
+		headers = {}
+		if meta[0]:
+			headers['If-None-Match'] = meta[0]
+		if meta[1]:
+			headers['If-Modified-Since'] = meta[1]
+		if headers:
+			return headers
+	return {'If-Modified-Since':email.utils.formatdate(os.path.getmtime(destination),usegmt=True)}
+
+# ---------------------------------------------
+def Deferral(url):
+	# Returns the reason for not trying to download url now, or an empty string if it should be tried
+	if args.retry:
+		return ''
+	with dbLock:
+		row = db.execute('SELECT message,attempts,permanent,next FROM ledger WHERE url=?',(url,)).fetchone()
+	if not(row):
+		return ''
+	msg,attempts,permanent,nextAttempt = row
+	if permanent:
+		return 'permanent failure after {:d} attempts ({})'.format(attempts,msg)
+	if args.watch: # waiting for files to turn up is the point
+		return ''
+	if time.time() < nextAttempt:
+		return 'retry after {} ({})'.format(time.strftime('%Y-%m-%d %H:%M:%S',time.gmtime(nextAttempt)),msg)
+	return ''
+
+# ---------------------------------------------
+def RecordAttempt(url,status,msg):
+	# Updates the ledger with the outcome of a download
+	if status in [SKIPPED,DEFERRED]: # nothing was attempted
+		return
+	if msg == NOT_LISTED: # checking the listing again is cheap, and it may be out of date, so this doesn't count as an attempt
+		return
+	now = time.time()
+	with dbLock:
+		row = db.execute('SELECT attempts,first FROM ledger WHERE url=?',(url,)).fetchone()
+		attempts,first = (0,now) if (not(row) or status in [DOWNLOADED,NOTMODIFIED]) else row
+		attempts += 1
+		permanent = 0
+		nextAttempt = now
+		if status in [FAILED,MISSING]:
+			# There's no point in trying again if we couldn't work out the file name or the server says it's gone
+			permanent = int(msg == 'no file name' or msg.startswith('HTTP 410') or (attempts >= GIVE_UP_ATTEMPTS and not(args.watch)))
+			nextAttempt = now + min(BACKOFF_START*2**(attempts - 1),BACKOFF_MAX)
+		db.execute('INSERT OR REPLACE INTO ledger VALUES (?,?,?,?,?,?,?,?)',(url,status,msg,attempts,permanent,first,now,nextAttempt))
+		db.commit()
+
+# ---------------------------------------------
+def FetchListing(session,directory):
+	# Returns the set of file names in a remote directory, or None if the listing could not be obtained
+	# Some servers don't list directories at all, so only a successful listing is trusted
+	try:
+		r = session.get(directory)
+	except requests.exceptions.RequestException as e:
+		ottp.Debug('Failed to list {} ({})'.format(directory,e))
+		return None
+	if r.status_code != 200:
+		ottp.Debug('Failed to list {} (HTTP {:d})'.format(directory,r.status_code))
+		return None
+	if r.url.rstrip('/') != directory.rstrip('/'): # ended up somewhere else, typically a login page (a login can end back at the directory)
+		ottp.Debug('Failed to list {} (redirected to {})'.format(directory,r.url))
+		return None
+	if 'html' in r.headers.get('Content-Type',''): # the usual web server listing
+		path = urllib.parse.unquote(urllib.parse.urlparse(directory).path).rstrip('/')
+		if not(path in urllib.parse.unquote(r.text)): # listings have the directory in the title, or as a heading
+			ottp.Debug('Failed to list {} (not an index of the directory)'.format(directory))
+			return None
+		names = re.findall(r'href="([^"?#]+)"',r.text)
+		names = [urllib.parse.unquote(n) for n in names]
+		return set([n for n in names if not('/' in n)])
+	else: # plain text, one file per line, eg CDDIS '?list'
+		return set([line.split()[0] for line in r.text.splitlines() if line.strip()])
+
+# ---------------------------------------------
+def GetListing(session,directory,stale):
+	# Returns the cached listing of a remote directory, fetching it if it is too old (or stale is True)
+	# Returns None if the listing could not be obtained
+	with GetLock(listingLocks,directory): # so that each directory is listed only once
+		if not(stale) and directory in listings:
+			return listings[directory]
+		if not(stale):
+			with dbLock:
+				row = db.execute('SELECT files,fetched FROM listings WHERE directory=?',(directory,)).fetchone()
+			if row and time.time() - row[1] < listingTTL:
+				listings[directory] = set(row[0].split('\n')) if row[0] else set()
+				return listings[directory]
+		ottp.Debug('Listing ' + directory)
+		files = FetchListing(session,directory)
+		listings[directory] = files # don't try again during this run if there's no listing
+		listed.add(directory)
+		if files is None:
+			return None
+		with dbLock:
+			db.execute('INSERT OR REPLACE INTO listings VALUES (?,?,?)',(directory,'\n'.join(sorted(files)),time.time()))
+			db.commit()
+		return files
+
+# ---------------------------------------------
+def RemoteFileExists(session,url):
+	# Checks the remote directory listing for the file
+	# If the file is not in a cached listing, the listing is refreshed, since the file may be new
+	# If there is no listing, we'll just have to try downloading the file
+	directory,fname = url.rsplit('/',1)
+	directory += '/'
+	files = GetListing(session,directory,False)
+	if files is None:
+		return True
+	if not(fname in files) and not(directory in listed):
+		files = GetListing(session,directory,True)
+		if files is None:
+			return True
+	return fname in files
+
+# ---------------------------------------------
+def FetchManifest(session,directory):
+	# Returns [manifest name,text] for the checksum manifest of a remote directory, or None if there isn't one
+	files = listings.get(directory)
+	for name,algorithm in MANIFESTS:
+		if files is not None and not(name in files): # no point asking for it
+			continue
+		try:
+			r = session.get(directory + name)
+		except requests.exceptions.RequestException as e:
+			ottp.Debug('Failed to get {} ({})'.format(directory + name,e))
+			return None
+		if r.status_code == 200 and not('html' in r.headers.get('Content-Type','')):
+			return [name,r.text]
+	return None
+
+# ---------------------------------------------
+def GetManifest(session,directory,stale):
+	# Returns the cached checksums for a remote directory as [algorithm,{file name:hex digest}],
+	# fetching the manifest if it is too old (or stale is True)
+	# Returns None if there is no manifest
+	with GetLock(manifestLocks,directory): # so that each manifest is fetched only once
+		if not(stale) and directory in manifests:
+			return manifests[directory]
+		row = None
+		if not(stale):
+			with dbLock:
+				row = db.execute('SELECT name,sums,fetched FROM manifests WHERE directory=?',(directory,)).fetchone()
+			if row and time.time() - row[2] >= listingTTL:
+				row = None
+		if not(row):
+			ottp.Debug('Getting checksum manifest for ' + directory)
+			manifest = FetchManifest(session,directory)
+			manifestsFetched.add(directory)
+			row = manifest + [time.time()] if manifest else [None,None,time.time()]
+			with dbLock:
+				db.execute('INSERT OR REPLACE INTO manifests VALUES (?,?,?,?)',(directory,row[0],row[1],row[2]))
+				db.commit()
+		manifests[directory] = None
+		if row[0]:
+			sums = {}
+			for line in row[1].splitlines():
+				fields = line.split()
+				if len(fields) >= 2:
+					sums[fields[-1].lstrip('*')] = fields[0].lower() # '*' marks binary mode
+			manifests[directory] = [dict(MANIFESTS)[row[0]],sums]
+		return manifests[directory]
+
+# ---------------------------------------------
+def ManifestChecksum(session,url,stale):
+	# Returns [algorithm,hex digest] for url from the directory's checksum manifest, or None if it's not known
+	# As for listings, a manifest that doesn't have the file is fetched again, since the file may be new
+	directory,fname = url.rsplit('/',1)
+	directory += '/'
+	manifest = GetManifest(session,directory,stale and not(directory in manifestsFetched))
+	if manifest and not(fname in manifest[1]) and not(directory in manifestsFetched):
+		manifest = GetManifest(session,directory,True)
+	if not(manifest) or not(fname in manifest[1]):
+		ottp.Debug('No checksum for ' + url)
+		return None
+	return [manifest[0],manifest[1][fname]]
+
+# ---------------------------------------------
+def QueueDownload(mjd,url,destination,fileFormat,pathKey=None,station=None):
+	# Adds a file to the download plan, unless it's already there (eg weekly and monthly files)
+	# The file is recorded as being needed for day mjd, and for station if it is station data
+	# pathKey identifies the data centre path that url was made with, so that the equivalent
+	# URLs on the mirrors can be added
+	dayFiles.setdefault(mjd,[]).append(destination)
+	if station:
+		stationFiles[destination] = station
+	if pathKey in TIERED_PATHS and not(url.endswith('/')): # a file that can actually be fetched
+		productFiles.setdefault(mjd,[]).append(destination)
+	if destination in plan:
+		return
+	sources = [[dataCentre,url]]
+	if pathKey:
+		prefix = '{}/{}/'.format(cfg[dataCentre + ':base url'],cfg[dataCentre + ':' + pathKey])
+		for c in mirrors:
+			if url.startswith(prefix) and (c + ':' + pathKey) in cfg:
+				sources.append([c,'{}/{}/{}'.format(cfg[c + ':base url'],cfg[c + ':' + pathKey],url[len(prefix):])])
+	plan[destination] = [sources,destination,fileFormat]
+
+# ---------------------------------------------
+def LoadCookies(session,cookieFile):
+	# Adds the cookies saved by previous runs to the session, so that logins don't have to be repeated
+	# Expired cookies are dropped
+	if not(os.path.isfile(cookieFile)):
+		return
+	jar = http.cookiejar.MozillaCookieJar(cookieFile)
+	try:
+		jar.load()
+	except (OSError,http.cookiejar.LoadError) as e:
+		ottp.Debug('Failed to load cookies from {} ({})'.format(cookieFile,e))
+		return
+	for c in jar:
+		session.cookies.set_cookie(c)
+	ottp.Debug('Loaded {:d} cookies from {}'.format(len(jar),cookieFile))
+
+# ---------------------------------------------
+def SaveCookies(session,cookieFile):
+	# Saves the session's cookies for the next run
+	# Session cookies are given an expiry time, so that they are not used for ever
+	# The file is only readable by the user, since the cookies are as good as a password
+	jar = http.cookiejar.MozillaCookieJar(cookieFile)
+	for c in session.cookies:
+		if c.expires is None:
+			c.expires = int(time.time() + COOKIE_TTL)
+			c.discard = False
+		jar.set_cookie(c)
+	try:
+		os.close(os.open(cookieFile,os.O_WRONLY|os.O_CREAT,0o600))
+		os.chmod(cookieFile,0o600) # in case it already existed
+		jar.save()
+	except OSError as e:
+		ottp.Debug('Failed to save cookies to {} ({})'.format(cookieFile,e))
+
+# ---------------------------------------------
+def LoadMirrorStats(centres):
+	stats = {}
+	for c in centres:
+		row = db.execute('SELECT latency,throughput,successes,failures FROM mirrors WHERE centre=?',(c,)).fetchone()
+		if row:
+			stats[c] = {'latency':row[0],'throughput':row[1],'successes':row[2],'failures':row[3],'reachable':True}
+		else:
+			stats[c] = {'latency':None,'throughput':None,'successes':0,'failures':0,'reachable':True}
+	return stats
+
+# ---------------------------------------------
+def SaveMirrorStats():
+	with dbLock:
+		for c,st in mirrorStats.items():
+			db.execute('INSERT OR REPLACE INTO mirrors VALUES (?,?,?,?,?,?)',(c,st['latency'],st['throughput'],st['successes'],st['failures'],time.time()))
+		db.commit()
+
+# ---------------------------------------------
+def Average(old,new):
+	# Running average
+	if old is None:
+		return new
+	return (1.0 - STATS_WEIGHT)*old + STATS_WEIGHT*new
+
+# ---------------------------------------------
+def ProbeMirrors(session):
+	# Measures the latency of each data centre
+	for c,st in mirrorStats.items():
+		try:
+			with session.get(cfg[c + ':base url'],stream=True,timeout=PROBE_TIMEOUT) as r:
+				st['latency'] = Average(st['latency'],r.elapsed.total_seconds())
+				ottp.Debug('{} latency {:.3f} s'.format(c,r.elapsed.total_seconds()))
+		except Exception as e:
+			ottp.Debug('{} is unreachable ({})'.format(c,e))
+			st['reachable'] = False
+			st['failures'] += 1
+
+# ---------------------------------------------
+def ExpectedTime(centre):
+	# The expected time to download a file from a data centre, allowing for how often downloads fail
+	st = mirrorStats[centre]
+	if not(st['reachable']):
+		return float('inf')
+	t = st['latency'] or 0.0
+	if st['throughput']:
+		t += RANK_SIZE/st['throughput']
+	successRate = (st['successes'] + 1.0)/(st['successes'] + st['failures'] + 2.0)
+	return t/successRate
+
+# ---------------------------------------------
+def UpdateMirrorStats(centre,status,elapsed,nBytes):
+	with mirrorLock:
+		st = mirrorStats[centre]
+		if status == DOWNLOADED:
+			st['successes'] += 1
+			if nBytes >= MIN_RATE_SIZE and elapsed > 0:
+				st['throughput'] = Average(st['throughput'],nBytes/elapsed)
+		elif status == FAILED:
+			st['failures'] += 1
+
+# ---------------------------------------------
+def GetLock(locks,key,limit=1):
+	# Returns the semaphore for key, creating it if necessary
+	with locksLock:
+		if not(key in locks):
+			locks[key] = threading.BoundedSemaphore(limit)
+		return locks[key]
+
+# ---------------------------------------------
+def Download(session,sources,destination,fileFormat):
+	# Runs in a worker thread
+	# sources is a list of [data centre,url]; the best is tried first, and then the others if that doesn't work
+	# The number of simultaneous connections to each host is limited
+	# Returns the URL tried first, the status and a message
+	if len(sources) > 1: # unreachable mirrors are left out, unless there's nothing else
+		ranked = sorted(sources,key=lambda src: ExpectedTime(src[0]))
+		sources = [src for src in ranked if mirrorStats[src[0]]['reachable']] or ranked[:1]
+	results = []
+	for centre,url in sources:
+		metrics = {'bytes':0,'http':None,'ttfb':None,'attempts':0,'validation':None}
+		hostLock = GetLock(hostLocks,urllib.parse.urlparse(url).netloc,maxHostJobs)
+		with hostLock:
+			tStart = time.time()
+			try:
+				status,msg = FetchFile(session,url,destination,fileFormat,metrics,hostLock)
+			except Exception as e:
+				ottp.Debug('Failed to download {} ({})'.format(url,e))
+				status,msg = (FAILED,str(e))
+			elapsed = time.time() - tStart
+		RecordAttempt(url,status,msg)
+		LogTransfer(centre,url,destination,status,msg,elapsed,metrics)
+		if centre in mirrorStats:
+			UpdateMirrorStats(centre,status,elapsed,metrics['bytes'])
+		if status in [DOWNLOADED,SKIPPED,NOTMODIFIED]:
+			if results:
+				msg = '{}, from {}'.format(msg,centre)
+			return (url,status,msg)
+		results.append([url,status,msg])
+		if len(sources) > 1:
+			ottp.Debug('Failing over from {} ({})'.format(centre,msg))
+	if len(results) > 1:
+		return (results[0][0],results[0][1],'; '.join(['{} {}'.format(r[0],r[2]) for r in results]))
+	return tuple(results[0])
+
+# ---------------------------------------------
+def LogTransfer(centre,url,destination,status,msg,elapsed,metrics):
+	# Writes a line to the transfer log, and adds to the totals for the summary
+	if not(transferLog) or status in [SKIPPED,DEFERRED]: # there was no transfer
+		return
+	host = urllib.parse.urlparse(url).netloc
+	record = {'type':'transfer','time':time.strftime('%Y-%m-%dT%H:%M:%SZ',time.gmtime()),'centre':centre,'url':url,
+		'destination':destination,'status':status,'message':msg,'http':metrics['http'],'bytes':metrics['bytes'],
+		'ttfb':metrics['ttfb'],'seconds':round(elapsed,6),'throughput':round(metrics['bytes']/elapsed,1) if elapsed > 0 else None,
+		'retries':max(0,metrics['attempts'] - 1),'validation':metrics['validation']}
+	with logLock:
+		transferLog.write(json.dumps(record) + '\n')
+		transferLog.flush()
+		totals = hostTotals.setdefault(host,{'transfers':0,'bytes':0,'seconds':0.0,'retries':0})
+		totals['transfers'] += 1
+		totals['bytes'] += metrics['bytes']
+		totals['seconds'] += elapsed
+		totals['retries'] += record['retries']
+
+# ---------------------------------------------
+def LogSummary(results,tStart):
+	# Writes the summary of the run to the transfer log
+	elapsed = time.time() - tStart
+	nBytes = sum([t['bytes'] for t in hostTotals.values()])
+	for t in hostTotals.values():
+		t['seconds'] = round(t['seconds'],3)
+	counts = {}
+	for r in results:
+		counts[r[2]] = counts.get(r[2],0) + 1
+	record = {'type':'summary','time':time.strftime('%Y-%m-%dT%H:%M:%SZ',time.gmtime()),'files':len(results),
+		'counts':counts,'bytes':nBytes,'seconds':round(elapsed,3),'throughput':round(nBytes/elapsed,1) if elapsed > 0 else None,
+		'jobs':nJobs,'hostjobs':maxHostJobs,'hosts':hostTotals}
+	transferLog.write(json.dumps(record) + '\n')
+	transferLog.flush()
+
+# ---------------------------------------------
+def FetchAll(session,downloads,nJobs):
+	# Downloads everything in the queue, using a pool of nJobs workers
+	# Returns a list of [url,destination,status,message], in the order of the queue
+	results = [None]*len(downloads)
+	with concurrent.futures.ThreadPoolExecutor(max_workers=nJobs) as pool:
+		futures = {}
+		for i,(sources,destination,fileFormat) in enumerate(downloads):
+			futures[pool.submit(Download,session,sources,destination,fileFormat)] = i
+		for f in concurrent.futures.as_completed(futures):
+			i = futures[f]
+			url,status,msg = f.result()
+			results[i] = [url,downloads[i][1],status,msg]
+			ottp.Debug('{} {} ({})'.format(status,downloads[i][1],msg))
+	return results
+
+# ---------------------------------------------
+def DayReady(mjd,destinations):
+	# Announces that all of the files for a day are available, by writing a marker file and/or running the hook
+	if args.readydir:
+		marker = os.path.join(args.readydir,'{:d}.ready'.format(mjd))
+		if os.path.exists(marker): # announced by an earlier run
+			return
+		with open(marker + PART_EXT,'w') as fout:
+			for d in destinations:
+				fout.write(d + '\n')
+		os.replace(marker + PART_EXT,marker)
+	print('{} MJD {:d} ready'.format(time.strftime('%Y-%m-%d %H:%M:%S',time.gmtime()),mjd))
+	if args.hook:
+		try:
+			hooks.append(subprocess.Popen(shlex.split(args.hook) + [str(mjd)]))
+		except OSError as e:
+			print('Failed to run {} ({})'.format(args.hook,e))
+
+# ---------------------------------------------
+def Watch(session):
+	# Polls for the planned files until interrupted, fetching each one as soon as it is published
+	# Files already being waited on are retried on every poll, rather than according to the ledger
+	global hostTotals
+	interval = POLL_MIN
+	fetched = set() # days with a file downloaded by this process
+	announced = set()
+	try:
+		while True:
+			start,stop = DownloadRange() # the day may have rolled over
+			PlanDownloads(range(start,stop+1))
+			listings.clear() # so that directories with files still to come are listed again
+			listed.clear()
+			manifests.clear()
+			manifestsFetched.clear()
+			hostTotals = {}
+			tStart = time.time()
+			results = FetchAll(session,list(plan.values()),nJobs)
+			if transferLog:
+				LogSummary(results,tStart)
+			if mirrors:
+				SaveMirrorStats()
+			if cookieFile:
+				SaveCookies(session,cookieFile)
+			
+			downloaded = set([r[1] for r in results if r[2] == DOWNLOADED])
+			for r in results:
+				if r[2] == DOWNLOADED:
+					print('{} downloaded {}'.format(time.strftime('%Y-%m-%d %H:%M:%S',time.gmtime()),r[0]))
+				elif r[2] == FAILED:
+					print('{} FAILED {} ({})'.format(time.strftime('%Y-%m-%d %H:%M:%S',time.gmtime()),r[0],r[3]))
+			for mjd,destinations in dayFiles.items():
+				if downloaded.intersection(destinations):
+					fetched.add(mjd)
+				if mjd in fetched and not(mjd in announced) and all([os.path.isfile(d) for d in destinations]):
+					DayReady(mjd,destinations)
+					announced.add(mjd)
+			
+			hooks[:] = [h for h in hooks if h.poll() is None] # reap finished hooks
+			
+			waiting = len([r for r in results if not(r[2] in [DOWNLOADED,SKIPPED,NOTMODIFIED])])
+			if downloaded:
+				interval = POLL_MIN
+			else:
+				interval = min(2*interval,pollInterval)
+			ottp.Debug('{:d} files to come, next poll in {:d} s'.format(waiting,interval))
+			time.sleep(interval)
+	except KeyboardInterrupt:
+		pass
+		
+# ---------------------------------------------
+def TieredDays(start,stop):
+	# Returns the days to fetch products for in tiered mode, and sets the tier to try first for each of them
+	# As well as start to stop, these are the recent days still on rapid products, which may now have final products
+	mjdToday = ottp.MJD(time.time())
+	rows = []
+	if db:
+		try:
+			with dbLock:
+				rows = db.execute('SELECT mjd FROM tiers WHERE tier=? AND mjd>=?',(RAPID,mjdToday - FINAL_GIVE_UP)).fetchall()
+		except sqlite3.OperationalError: # a dry run with an older database
+			pass
+	days = sorted(set(list(range(start,stop+1)) + [r[0] for r in rows]))
+	for m in days:
+		dayTiers[m] = FINAL if m <= mjdToday - FINAL_LATENCY else RAPID # don't waste attempts on finals before they're due
+	return days
+
+# ---------------------------------------------
+def ProductsPresent(mjd):
+	# Returns True if all of the tiered products for a day have been fetched
+	return bool(productFiles.get(mjd)) and all([os.path.isfile(d) for d in productFiles[mjd]])
+
+# ---------------------------------------------
+def RecordTiers(days):
+	# Records the tier of products each day has, if they're all present
+	# Returns the days that have been upgraded from rapid to final products
+	upgraded = []
+	for m in days:
+		if not(ProductsPresent(m)):
+			continue
+		with dbLock:
+			row = db.execute('SELECT tier FROM tiers WHERE mjd=?',(m,)).fetchone()
+			if row and (row[0] == dayTiers[m] or (row[0] == RAPID_ONLY and dayTiers[m] == RAPID)):
+				continue
+			db.execute('INSERT OR REPLACE INTO tiers VALUES (?,?,?)',(m,dayTiers[m],time.time()))
+			db.commit()
+		ottp.Debug('MJD {:d} has {} products'.format(m,dayTiers[m]))
+		if row and row[0] in [RAPID,RAPID_ONLY] and dayTiers[m] == FINAL:
+			upgraded.append(m)
+	return upgraded
+
+# ---------------------------------------------
+def FinalsAbandoned(mjd):
+	# Returns True if the ledger has given up on any of the final products for a day, so that it will stay on rapid products
+	for d in productFiles.get(mjd,[]):
+		urls = [s[1] for s in plan[d][0]]
+		with dbLock:
+			row = db.execute('SELECT url FROM ledger WHERE permanent=1 AND url IN ({})'.format(','.join(['?']*len(urls))),urls).fetchone()
+		if row:
+			return True
+	return False
+
+# ---------------------------------------------
+def FetchTiered(session,days,nJobs):
+	# Fetches final products for the days that might have them, and rapid products for the rest,
+	# including those days that turn out not to have final products yet
+	# Returns the results, as for FetchAll, and the days that have been upgraded to final products
+	PlanDownloads(days)
+	results = FetchAll(session,list(plan.values()),nJobs)
+	upgraded = RecordTiers(days)
+	fallback = [m for m in days if dayTiers[m] == FINAL and not(ProductsPresent(m))]
+	if fallback:
+		ottp.Debug('No final products yet for MJD ' + ' '.join([str(m) for m in fallback]))
+		done = set([r[1] for r in results]) # files that aren't tiered will have been fetched already
+		notYet = set() # final products that aren't missing as such, since they're replaced by rapid products
+		abandoned = [m for m in fallback if FinalsAbandoned(m)]
+		for m in fallback:
+			dayTiers[m] = RAPID
+			notYet.update(productFiles.get(m,[]))
+		results = [r for r in results if not(r[1] in notYet and r[2] in [MISSING,DEFERRED])]
+		PlanDownloads(fallback)
+		results += FetchAll(session,[d for d in plan.values() if not(d[1] in done)],nJobs)
+		RecordTiers(fallback)
+		for m in abandoned: # so that later runs stop looking for its final products
+			ottp.Debug('Final products for MJD {:d} have been given up on'.format(m))
+			with dbLock:
+				db.execute('UPDATE tiers SET tier=?,updated=? WHERE mjd=? AND tier=?',(RAPID_ONLY,time.time(),m,RAPID))
+				db.commit()
+	return results,upgraded
 
 # ---------------------------------------------
 def  IGSBiasFile(biasCentre,fileFormat,product,yyyy,doy):
@@ -156,6 +1312,192 @@ def CODEBiasFile(yy,mm):
 	fnames.append('P1P2{:02d}{:02d}.DCB.Z'.format(yy,mm))
 	return fnames
 
+# ---------------------------------------------
+def DownloadRange():
+	# Returns the first and last MJD to download
+	
+	today = time.time() # save this in case the day rolls over while the script is running
+	mjdToday = ottp.MJD(today)
+	
+	# If observations or broadcast ephemeris, at best we can only get yesterday's files
+	# 
+	start = mjdToday - 1 - nprev # 
+	stop  = mjdToday - 1
+	
+	# For IGS rapid products, the latemcy is 17 hours so subtract another day
+	if args.rapid or args.tiered:
+		start = start - 1
+		stop  = stop  - 1
+	
+	if args.final:
+		start = start - 14
+		stop  = stop  - 14
+	
+	# Otherwise, the user has defined the download range, and we assume that they know what they're doing :-)
+	if (args.start):
+		start = DateToMJD(args.start)
+		if not(args.stop):
+			start = start -  nprev
+			stop  = start
+	
+	if (args.stop):
+		stop = DateToMJD(args.stop)
+	elif args.watch and args.rapid and not(args.start):
+		stop = mjdToday - 1 # so that yesterday's products are fetched as soon as they're published
+	
+	return (start,stop)
+
+# ---------------------------------------------
+def PlanDownloads(days):
+	# Works out the files needed for each of days, and adds them to the download plan
+	# Products are of the tier in dayTiers, if the day is there
+	
+	plan.clear()
+	dayFiles.clear()
+	stationFiles.clear()
+	productFiles.clear()
+	
+	for m in days:
+	
+		(yyyy,doy,mm)  = ottp.MJDtoYYYYDOY(m)
+		(GPSWn,GPSday) = ottp.MJDtoGPSWeekDay(m)
+		yy = yyyy-100*int(yyyy/100)
+		tier = dayTiers.get(m,RAPID if args.rapid else FINAL)
+	
+		ottp.Debug('fetching files for MJD {:d}, Y {:d} DOY {:d}, Wn {:d} Dn {:d}'.format(m,yyyy,doy,GPSWn,GPSday))
+	
+		# IGS products needed for PPP 
+		# CDDIS changed to RINEXV3 style names  after WN 2237
+	
+		if (args.clocks):
+			fileFormat = GZIP
+	
+			if tier == RAPID:
+				dstdir = rapiddir
+				if GPSWn > 2237:  
+					fname = 'IGS0OPSRAP_{:04d}{:03d}0000_01D_05M_CLK.CLK.gz'.format(yyyy,doy) 
+				else:	
+					fname = 'igr{:04d}{:1d}.clk.Z'.format(GPSWn,GPSday) # 5 minute clocks
+					fileFormat = UNIXCOMPRESS
+			elif tier == FINAL:
+				dstdir = finaldir
+				if GPSWn > 2237:
+					fname = 'IGS0OPSFIN_{:04d}{:03d}0000_01D_05M_CLK.CLK.gz'.format(yyyy,doy) 
+				else:
+					fname = 'igs{:04d}{:1d}.clk.Z'.format(GPSWn,GPSday)
+					fileFormat = UNIXCOMPRESS
+	
+			url = '{}/{}/{:04d}/{}'.format(baseURL,productPath,GPSWn,fname)
+			QueueDownload(m,url,'{}/{}'.format(dstdir,fname),fileFormat,'products')
+	
+		if (args.orbits):
+			fileFormat = GZIP
+	
+			if tier == RAPID:
+				dstdir = rapiddir
+				if GPSWn > 2237:
+					fname = 'IGS0OPSRAP_{:04d}{:03d}0000_01D_15M_ORB.SP3.gz'.format(yyyy,doy)
+				else:
+					fname = 'igr{:04d}{:1d}.sp3.Z'.format(GPSWn,GPSday)
+					fileFormat = UNIXCOMPRESS
+			elif tier == FINAL:
+				dstdir = finaldir
+				if GPSWn > 2237:
+					fname = 'IGS0OPSFIN_{:04d}{:03d}0000_01D_15M_ORB.SP3.gz'.format(yyyy,doy)
+				else:
+					fname = 'igs{:04d}{:1d}.sp3.Z'.format(GPSWn,GPSday)
+					fileFormat = UNIXCOMPRESS
+	
+			url = '{}/{}/{:04d}/{}'.format(baseURL,productPath,GPSWn,fname)
+			QueueDownload(m,url,'{}/{}'.format(dstdir,fname),fileFormat,'products')
+	
+		if (args.erp):
+			fileFormat = GZIP
+	
+			if tier == RAPID: # published each day
+				dstdir = rapiddir
+				if GPSWn > 2237:
+					fname = 'IGS0OPSRAP_{:04d}{:03d}0000_01D_01D_ERP.ERP.gz'.format(yyyy,doy)
+				else:
+					fname = 'igr{:04d}{:1d}.erp.Z'.format(GPSWn,GPSday)
+					fileFormat = UNIXCOMPRESS
+			elif tier == FINAL:
+				dstdir = finaldir
+				if GPSWn > 2237: # published for first day of GPS week
+					(tmpyyyy,tmpdoy,tmpmon) = ottp.MJDtoYYYYDOY(m - GPSday)
+					fname = 'IGS0OPSFIN_{:04d}{:03d}0000_07D_01D_ERP.ERP.gz'.format(tmpyyyy,tmpdoy)
+				else:
+					fname = 'igs{:04d}{:1d}.erp.Z'.format(GPSWn,7) # published at end of week (GPSday == 7)
+					fileFormat = UNIXCOMPRESS
+	
+			url = '{}/{}/{:04d}/{}'.format(baseURL,productPath,GPSWn,fname)
+			QueueDownload(m,url,'{}/{}'.format(dstdir,fname),fileFormat,'products')
+	
+		if (args.bias):
+	
+			if biasFormat== 'OSBBIA': # these are downloaded from the IGS data centre
+				fname = IGSBiasFile(biasCentre,biasFormat,tier,yyyy,doy)
+				url = '{}/{}/{:04d}/{}'.format(baseURL,osbBiaProductPath,GPSWn,fname)
+				QueueDownload(m,url,'{}/{}'.format(biasdir,fname),GZIP,'osb bias')
+			elif biasFormat== 'DCBBIA':
+				fname = IGSBiasFile(biasCentre,biasFormat,tier,yyyy,doy)
+				url = '{}/{}/{:04d}/{}'.format(baseURL,dcbBiaProductPath,yyyy,fname)
+				QueueDownload(m,url,'{}/{}'.format(biasdir,fname),GZIP,'dcb bias')
+			elif biasFormat == 'DCB': # legacy stuff 
+				prevmm = mm - 1
+				prevyy = yy
+				if prevmm == 0:
+					prevmm = 12
+					prevyy = prevyy -1
+				fnames = CODEBiasFile(prevyy,prevmm)
+				for f in fnames:
+					url = '{}/{:04d}/{}'.format(cfg['bias:code'],yyyy,f)
+					QueueDownload(m,url,'{}/{}'.format(biasdir,f),UNIXCOMPRESS)
+	
+		# Miscellanea - broadcast ephemeris
+		if (args.ephemeris):
+			if (rnxVersion == 2): # GPS only!
+				for brdcName in (stationIDs or ['brdc']):
+					fileFormat = GZIP
+					fname = '{}{:03d}0.{:02d}n.Z'.format(brdcName,doy,yy)
+					if brdcName == 'brdc':
+						fname = '{}{:03d}0.{:02d}n.gz'.format(brdcName,doy,yy)
+						url = '{}/{}/{:04d}/brdc/{}'.format(baseURL,brdcPath,yyyy,fname)
+					else:  
+						url = '{}/{}/{:04d}/{:03d}/{:02d}n/{}'.format(baseURL,brdcPath,yyyy,doy,yy,fname)
+						fileFormat = UNIXCOMPRESS
+					QueueDownload(m,url,'{}/{}'.format(outputdir,fname),fileFormat,'broadcast ephemeris',None if brdcName == 'brdc' else brdcName)
+	
+			elif (rnxVersion == 3):
+				fileFormat = GZIP
+				for stationID in stationIDs:
+					fname = '{}_R_{:04d}{:03d}0000_01D_{}N.rnx.gz'.format(stationID,yyyy,doy,gnss)
+					url = '{}/{}/{:04d}/{:03d}/{:02d}{}/{}'.format(baseURL,stationDataPath,yyyy,doy,yy,
+						GNSStoNavDirectory(gnss),fname)
+					QueueDownload(m,url,'{}/{}'.format(outputdir,fname),fileFormat,'station data',stationID)
+				if not(stationIDs): # we want the IGS combined ephemeris
+					fname = 'BRDC00IGS_R_{:04d}{:03d}0000_01D_MN.rnx.gz'.format(yyyy,doy)
+					url = '{}/{}/{:04d}/brdc/{}'.format(baseURL,stationDataPath,yyyy,fname)
+					QueueDownload(m,url,'{}/{}'.format(outputdir,fname),fileFormat,'station data')
+	
+		# Miscellanea - station observations
+		if (args.observations):
+			fileFormat = GZIP
+			obsGNSS = MIXED # FIXME maybe
+			if not(obsGNSS == MIXED):
+				print('Warning: only mixed observation files are downloaded - skipping ...')
+			elif (rnxVersion == 2):
+				for stationID in stationIDs:
+					fname = '{}{:03d}0.{}o.Z'.format(stationID,doy,yy)
+					url = '{}/{}/{:04d}/{:03d}/{:02d}o/{}'.format(baseURL,stationDataPath,yyyy,doy,yy,fname)
+					QueueDownload(m,url,'{}/{}'.format(outputdir,fname),fileFormat,'station data',stationID)
+			elif (rnxVersion == 3):
+				for stationID in stationIDs:
+					fname = '{}_R_{:04d}{:03d}0000_01D_30S_{}O.crx.gz'.format(stationID,yyyy,doy,obsGNSS)
+					# MO in 'd'
+					url = '{}/{}/{:04d}/{:03d}/{:02d}d/{}'.format(baseURL,stationDataPath,yyyy,doy,yy,fname)
+					QueueDownload(m,url,'{}/{}'.format(outputdir,fname),fileFormat,'station data',stationID)
+
 # ---------------------------------------------
 # Main
 
@@ -169,6 +1511,12 @@ biasFormat = 'OSBBIA'
 examples =  'Examples:\n'
 examples += '1. Download combined IGS ephemeris files for 2022\n'
 examples += 'getgnssproducts.py--config ~/etc/getgnssproducts.conf --system MIXED --ephemeris --rinexversion 3 --outputdir ~/rinex/nav 2022-001 2022-365\n'
+examples += '2. Download RINEX V3 observations for the stations listed in stations.txt for the last week\n'
+examples += 'getgnssproducts.py --observations --statidfile stations.txt --ndays 6 --jobs 4 --outputdir ~/rinex/obs\n'
+examples += '3. Get the best PPP products available for the last 30 days, and list the days that now have final products\n'
+examples += 'getgnssproducts.py --ppp --tiered --ndays 29 --rerun ~/logs/rerun.txt\n'
+examples += '4. Fetch the rapid PPP products for the last two days as soon as they are published, running a script on each completed day\n'
+examples += 'getgnssproducts.py --ppp --rapid --ndays 1 --watch --hook ~/bin/processday.sh\n'
 
 parser = argparse.ArgumentParser(description='Downloads GNSS products',
 	formatter_class=argparse.RawDescriptionHelpFormatter,epilog = examples)
@@ -188,7 +1536,8 @@ parser.add_argument('--listcentres','-l',help='list the configured IGS data cent
 # RINEX files
 parser.add_argument('--ephemeris',help='get broadcast ephemeris. If statid unspecified then the combined IGS file is fetched. If V2, only the GPS ephemeris is fetched',action='store_true')
 parser.add_argument('--observations',help='get station observations',action='store_true')
-parser.add_argument('--statid',help='station identifier (eg V3 SYDN00AUS, V2 sydn)')
+parser.add_argument('--statid',help='station identifier, or comma-separated list of them (eg V3 SYDN00AUS, V2 sydn)')
+parser.add_argument('--statidfile',help='file of station identifiers, one per line',metavar='FILE')
 parser.add_argument('--rinexversion',help='RINEX version of station observation')
 parser.add_argument('--system',help='gnss system (GLONASS,BEIDOU,GPS,GALILEO,MIXED')
 
@@ -212,12 +1561,36 @@ parser.add_argument('--finaldir',help='output directory for final products',defa
 # separate directory for bias products, since IGS does this too
 parser.add_argument('--biasdir',help='output directory for bias products',default ='')
 
+parser.add_argument('--stagedecompressed','--stage-decompressed',help='also put a decompressed copy of each file in this directory',metavar='DIR')
+parser.add_argument('--crx2rnx',help='Hatanaka decompression program, used when staging (default crx2rnx)',default='crx2rnx')
+parser.add_argument('--log',help='append a JSON record of each transfer, and a summary, to this file')
+parser.add_argument('--dryrun','--dry-run',help='print what would be downloaded and exit',action='store_true')
 parser.add_argument('--force','-f',help='force download, overwriting existing files',action='store_true')
+parser.add_argument('--refresh',help='download existing files again only if they have changed on the server',action='store_true')
+parser.add_argument('--store',help='keep one copy of each product in this shared directory, and link to it from the download directories',metavar='DIR')
+parser.add_argument('--symlinks',help='use symbolic links to the store, rather than hard links',action='store_true')
+parser.add_argument('--gc',help='remove products from the store that are no longer linked to, and exit',action='store_true')
+parser.add_argument('--cookies',help='file that login cookies are kept in between runs (default is getgnssproducts.cookies in the root directory)',metavar='FILE')
+parser.add_argument('--nocookies',help='do not reuse login cookies from previous runs',action='store_true')
+parser.add_argument('--database',help='database of downloaded files (default is getgnssproducts.db in the root directory)')
+parser.add_argument('--retry',help='try again to download files that have failed, ignoring the ledger',action='store_true')
+parser.add_argument('--mirrors',help='download each file from the best of the configured data centres, trying the others if that fails',action='store_true')
+parser.add_argument('--nolistings',help='do not check remote directory listings before downloading',action='store_true')
+parser.add_argument('--nochecksums',help='do not verify downloads against the checksum manifests published with them',action='store_true')
+parser.add_argument('--listingttl',help='seconds that a cached directory listing is used for (default {:d})'.format(LISTING_TTL),default=str(LISTING_TTL))
+parser.add_argument('--jobs','-j',help='number of simultaneous downloads (default 1)',default='1')
+parser.add_argument('--watch',help='keep running, fetching files as soon as they are published',action='store_true')
+parser.add_argument('--pollinterval',help='maximum seconds between polls in watch mode (default {:d})'.format(POLL_INTERVAL),default=str(POLL_INTERVAL))
+parser.add_argument('--hook',help='in watch mode, run this command, with the MJD as the last argument, when all of the files for a day have been fetched')
+parser.add_argument('--readydir',help='in watch mode, write MJD.ready to this directory when all of the files for a day have been fetched',metavar='DIR')
+parser.add_argument('--hostjobs',help='maximum number of simultaneous connections to each host (default 4)',default='4')
 
 group = parser.add_mutually_exclusive_group()
 group.add_argument('--rapid',help='get rapid products',action='store_true')
 group.add_argument('--final',help='get final products',action='store_true')
+group.add_argument('--tiered',help='get final products for days that have them, otherwise rapid products, upgrading days to final products when they appear (for up to {:d} days)'.format(FINAL_GIVE_UP),action='store_true')
 
+parser.add_argument('--rerun',help='with --tiered, append the MJDs of days upgraded to final products to this file',metavar='FILE')
 parser.add_argument('--noproxy',help='disable use of proxy server',action='store_true')
 parser.add_argument('--proxy',help='set the proxy server (server:port)',type=str)
 parser.add_argument('--version','-v',action='version',version = os.path.basename(sys.argv[0])+ ' ' + VERSION + '\n' + 'Written by ' + AUTHORS)
@@ -302,6 +1675,47 @@ if (args.biasdir):
 elif ('paths:bias directory' in cfg):
 	biasdir = ottp.MakeAbsolutePath(cfg['paths:bias directory'],root)
 
+stageDir = ''
+if (args.stagedecompressed):
+	stageDir = args.stagedecompressed
+elif ('paths:staging directory' in cfg):
+	stageDir = ottp.MakeAbsolutePath(cfg['paths:staging directory'],root)
+
+logFile = ''
+if (args.log):
+	logFile = args.log
+elif ('paths:transfer log' in cfg):
+	logFile = ottp.MakeAbsolutePath(cfg['paths:transfer log'],root)
+
+storeDir = ''
+if (args.store):
+	storeDir = args.store
+elif ('paths:store' in cfg):
+	storeDir = ottp.MakeAbsolutePath(cfg['paths:store'],root)
+store = None
+storeLock = threading.Lock()
+if args.gc:
+	if not(storeDir):
+		ottp.ErrorExit('There is no store to garbage collect (--store)')
+	store = OpenStore(storeDir)
+	CollectGarbage()
+	store.close()
+	sys.exit(0)
+	
+cookieFile = os.path.join(root,'getgnssproducts.cookies')
+if (args.cookies):
+	cookieFile = args.cookies
+elif ('paths:cookies' in cfg):
+	cookieFile = ottp.MakeAbsolutePath(cfg['paths:cookies'],root)
+if (args.nocookies):
+	cookieFile = ''
+	
+dbFile = os.path.join(root,'getgnssproducts.db')
+if (args.database):
+	dbFile = args.database
+elif ('paths:database' in cfg):
+	dbFile = ottp.MakeAbsolutePath(cfg['paths:database'],root)
+
 biasCentre = args.biascentre
 
 biasFormat = args.biasformat
@@ -314,12 +1728,22 @@ rnxVersion = 3
 if args.rinexversion:
 	rnxVersion = int(args.rinexversion)
 
-stationID=''
+stationIDs = []
 if (args.statid):
-	stationID = args.statid
+	stationIDs = [s.strip() for s in args.statid.split(',') if s.strip()]
+if (args.statidfile):
+	try:
+		with open(args.statidfile) as fin:
+			for line in fin:
+				line = line.split('#')[0].strip()
+				if line:
+					stationIDs.append(line)
+	except OSError as e:
+		ottp.ErrorExit('Unable to read {} ({})'.format(args.statidfile,e))
+stationIDs = list(dict.fromkeys(stationIDs)) # remove duplicates, keeping the order
 		
 if (args.observations): # station observations
-	if not args.statid:
+	if not stationIDs:
 		ottp.ErrorExit('You must define the station identifier (--statid)')
 
 #if (args.ephemeris and rnxVersion == 3): # station observations
@@ -349,7 +1773,7 @@ if (rnxVersion == 3 and args.system):
 		exit()
 
 if args.clocks or args.orbits or args.erp or args.bias or args.ppp:
-	if not(args.rapid or args.final):
+	if not(args.rapid or args.final or args.tiered):
 		if args.bias and (args.biasformat == 'OSBBIA' or args.biasformat == 'DCBBIA'): # FIXME this is based on CDDIS so may need fixups for other centres 
 			ottp.ErrorExit("You need to specify 'rapid' or 'final' products")
 		else:
@@ -368,37 +1792,11 @@ if args.ppp: # configure download of all required products
 # Now that we've defined the file types to download, set the MJD range for download
 nprev = int(args.ndays)
 
-today = time.time() # save this in case the day rolls over while the script is running
-mjdToday = ottp.MJD(today)
-
-# If observations or broadcast ephemeris, at best we can only get yesterday's files
-# 
-start = mjdToday - 1 - nprev # 
-stop  = mjdToday - 1
-
-# For IGS rapid products, the latemcy is 17 hours so subtract another day
-if args.rapid:
-	start = start - 1
-	stop  = stop  - 1
-	
-if args.final:
-	start = start - 14
-	stop  = stop  - 14
-
-# Otherwise, the user has defined the download range, and we assume that they know what they're doing :-)
-if (args.start):
-	start = DateToMJD(args.start)
-	if not(args.stop):
-		start = start -  nprev
-		stop  = start
-	
-if (args.stop):
-	stop = DateToMJD(args.stop)
-
+start,stop = DownloadRange()
 ottp.Debug('start = {},stop = {} '.format(start,stop))
 
 osbBiaProductPath  = cfg[dataCentre + ':osb bias']
-dcbBiasProductPath = cfg[dataCentre + ':dcb bias']
+dcbBiaProductPath  = cfg[dataCentre + ':dcb bias']
 
 # Daily data
 baseURL = cfg[dataCentre + ':base url']
@@ -408,155 +1806,145 @@ stationDataPath = cfg[dataCentre + ':station data']
 # Products
 productPath = cfg[dataCentre + ':products']
 
+nJobs = max(1,int(args.jobs))
+maxHostJobs = max(1,int(args.hostjobs))
+listingTTL  = int(args.listingttl)
+pollInterval = max(POLL_MIN,int(args.pollinterval))
+
+# Other data centres that files can be downloaded from
+mirrors = []
+if args.mirrors:
+	mirrors = [c.lower() for c in centres if c.lower() != dataCentre]
+
+# First, work out everything that's needed for the whole range
+plan = {} # destination -> [[[data centre,url],...],destination,file format], in the order queued
+dayFiles = {} # MJD -> destinations of the files needed for that day
+stationFiles = {} # destination -> station, for station data
+productFiles = {} # MJD -> destinations of the tiered products needed for that day
+dayTiers = {} # MJD -> product tier
+
+dbLock = threading.Lock()
+if args.dryrun: # don't touch the database, but tiered mode needs to know which days are waiting for final products
+	db = None
+	if args.tiered and os.path.isfile(dbFile):
+		db = sqlite3.connect('file:{}?mode=ro'.format(urllib.parse.quote(os.path.abspath(dbFile))),uri=True)
+else:
+	db = OpenDatabase(dbFile)
+
+days = range(start,stop+1)
+if args.tiered:
+	if args.watch:
+		ottp.ErrorExit('--tiered cannot be used with --watch')
+	days = TieredDays(start,stop)
+PlanDownloads(days)
+
+downloads = list(plan.values())
+
+if args.dryrun:
+	for sources,destination,fileFormat in downloads:
+		present = os.path.isfile(destination) and os.path.getsize(destination) > 0
+		print('{} -> {}{}'.format(sources[0][1],destination,' (present)' if present else ''))
+		for centre,url in sources[1:]:
+			print('  mirror {}'.format(url))
+	print('{:d} files'.format(len(downloads)))
+	sys.exit(0)
+
 session = requests.Session()
 session.proxies.update(proxies)
-
-for m in range(start,stop+1):
+# Size the connection pool so that connections are reused by all workers
+adapter = requests.adapters.HTTPAdapter(pool_connections=nJobs,pool_maxsize=nJobs)
+session.mount('https://',adapter)
+session.mount('http://',adapter)
+if cookieFile:
+	LoadCookies(session,cookieFile)
+
+if stageDir:
+	os.makedirs(stageDir,exist_ok=True)
+if args.readydir:
+	os.makedirs(args.readydir,exist_ok=True)
 	
-	(yyyy,doy,mm)  = ottp.MJDtoYYYYDOY(m)
-	(GPSWn,GPSday) = ottp.MJDtoGPSWeekDay(m)
-	yy = yyyy-100*int(yyyy/100)
-	
-	ottp.Debug('fetching files for MJD {:d}, Y {:d} DOY {:d}, Wn {:d} Dn {:d}'.format(m,yyyy,doy,GPSWn,GPSday))
+if storeDir:
+	store = OpenStore(storeDir)
+locksLock = threading.Lock()
+hostLocks = {}
+listingLocks = {}
+listings = {} # remote directory -> set of file names (None if there is no listing)
+listed = set() # remote directories listed during this run
+manifestLocks = {}
+manifests = {} # remote directory -> [algorithm,{file name:hex digest}] (None if there is no manifest)
+manifestsFetched = set() # remote directories whose manifest was fetched during this run
+
+mirrorLock = threading.Lock()
+mirrorStats = {}
+if mirrors:
+	mirrorStats = LoadMirrorStats([dataCentre] + mirrors)
+	ProbeMirrors(session)
+	for c in sorted(mirrorStats,key=ExpectedTime):
+		ottp.Debug('{} expected time {:.3f} s'.format(c,ExpectedTime(c)))
+		
+transferLog = None
+logLock = threading.Lock()
+hostTotals = {} # host -> totals for the summary
+if logFile:
+	transferLog = open(logFile,'a')
 	
-	# IGS products needed for PPP 
-	# CDDIS changed to RINEXV3 style names  after WN 2237
+if args.watch:
+	hooks = [] # hook processes that are still running
+	signal.signal(signal.SIGTERM,signal.default_int_handler) # so that stopping the daemon is like Ctrl-C
+	Watch(session)
+	if transferLog:
+		transferLog.close()
+	db.close()
+	if store:
+		store.close()
+	sys.exit(0)
 	
-	if (args.clocks):
-		magicTag = 'gzip compressed'
-		
-		if (args.rapid):
-			dstdir = rapiddir
-			if GPSWn > 2237:  
-				fname = 'IGS0OPSRAP_{:04d}{:03d}0000_01D_05M_CLK.CLK.gz'.format(yyyy,doy) 
-			else:	
-				fname = 'igr{:04d}{:1d}.clk.Z'.format(GPSWn,GPSday) # 5 minute clocks
-				magicTag = 'compress\'d'
-		elif (args.final):
-			dstdir = finaldir
-			if GPSWn > 2237:
-				fname = 'IGS0OPSFIN_{:04d}{:03d}0000_01D_05M_CLK.CLK.gz'.format(yyyy,doy) 
-			else:
-				fname = 'igs{:04d}{:1d}.clk.Z'.format(GPSWn,GPSday)
-				magicTag = 'compress\'d'
-				
-		url = '{}/{}/{:04d}/{}'.format(baseURL,productPath,GPSWn,fname)
-		FetchFile(session,url,'{}/{}'.format(dstdir,fname),magicTag)
-		
-	if (args.orbits):
-		magicTag = 'gzip compressed'
-		
-		if (args.rapid):
-			dstdir = rapiddir
-			if GPSWn > 2237:
-				fname = 'IGS0OPSRAP_{:04d}{:03d}0000_01D_15M_ORB.SP3.gz'.format(yyyy,doy)
-			else:
-				fname = 'igr{:04d}{:1d}.sp3.Z'.format(GPSWn,GPSday)
-				magicTag = 'compress\'d'
-		elif (args.final):
-			dstdir = finaldir
-			if GPSWn > 2237:
-				fname = 'IGS0OPSFIN_{:04d}{:03d}0000_01D_15M_ORB.SP3.gz'.format(yyyy,doy)
-			else:
-				fname = 'igs{:04d}{:1d}.sp3.Z'.format(GPSWn,GPSday)
-				magicTag = 'compress\'d'
-				
-		url = '{}/{}/{:04d}/{}'.format(baseURL,productPath,GPSWn,fname)
-		FetchFile(session,url,'{}/{}'.format(dstdir,fname),magicTag)
+tStart = time.time()
+upgraded = []
+if args.tiered:
+	results,upgraded = FetchTiered(session,days,nJobs)
+else:
+	results = FetchAll(session,downloads,nJobs)
+
+if transferLog:
+	LogSummary(results,tStart)
+	transferLog.close()
+
+if mirrors:
+	SaveMirrorStats()
+if cookieFile:
+	SaveCookies(session,cookieFile)
+db.close()
+if store:
+	store.close()
+
+nDownloaded = len([r for r in results if r[2] == DOWNLOADED])
+nSkipped = len([r for r in results if r[2] == SKIPPED])
+nNotModified = len([r for r in results if r[2] == NOTMODIFIED])
+nDeferred = len([r for r in results if r[2] == DEFERRED])
+missing = [r for r in results if r[2] == MISSING]
+failures = [r for r in results if r[2] == FAILED]
+if args.refresh:
+	print('{:d} downloaded, {:d} not modified, {:d} missing, {:d} deferred, {:d} failed'.format(nDownloaded,nNotModified,len(missing),nDeferred,len(failures)))
+else:
+	print('{:d} downloaded, {:d} already present, {:d} missing, {:d} deferred, {:d} failed'.format(nDownloaded,nSkipped,len(missing),nDeferred,len(failures)))
+for r in missing:
+	print('  MISSING {}'.format(r[0]))
+for r in failures:
+	print('  FAILED {} ({})'.format(r[0],r[3]))
+if upgraded: # downstream processing should be done again
+	print('Upgraded to final products: MJD {}'.format(' '.join([str(m) for m in upgraded])))
+	if args.rerun:
+		with open(args.rerun,'a') as fout:
+			for m in upgraded:
+				fout.write('{:d}\n'.format(m))
 	
-	if (args.erp):
-		magicTag = 'gzip compressed'
-		
-		if (args.rapid): # published each day
-			dstdir = rapiddir
-			if GPSWn > 2237:
-				fname = 'IGS0OPSRAP_{:04d}{:03d}0000_01D_01D_ERP.ERP.gz'.format(yyyy,doy)
-			else:
-				fname = 'igr{:04d}{:1d}.erp.Z'.format(GPSWn,GPSday)
-				magicTag = 'compress\'d'
-		elif (args.final):
-			dstdir = finaldir
-			if GPSWn > 2237: # published for first day of GPS week
-				(tmpyyyy,tmpdoy,tmpmon) = ottp.MJDtoYYYYDOY(m - GPSday)
-				fname = 'IGS0OPSFIN_{:04d}{:03d}0000_07D_01D_ERP.ERP.gz'.format(tmpyyyy,tmpdoy)
-			else:
-				fname = 'igs{:04d}{:1d}.erp.Z'.format(GPSWn,7) # published at end of week (GPSday == 7)
-				magicTag = 'compress\'d'
-				
-		url = '{}/{}/{:04d}/{}'.format(baseURL,productPath,GPSWn,fname)
-		FetchFile(session,url,'{}/{}'.format(dstdir,fname),magicTag)
-		
-	if (args.bias):
-		
-		if biasFormat== 'OSBBIA': # these are downloaded from the IGS data centre
-			fname = IGSBiasFile(biasCentre,biasFormat,'rapid' if args.rapid  else 'final',yyyy,doy)
-			url = '{}/{}/{:04d}/{}'.format(baseURL,osbBiaProductPath,GPSWn,fname)
-			FetchFile(session,url,'{}/{}'.format(biasdir,fname),'gzip compressed')
-		elif biasFormat== 'DCBBIA':
-			fname = IGSBiasFile(biasCentre,biasFormat,'rapid' if args.rapid  else 'final',yyyy,doy)
-			url = '{}/{}/{:04d}/{}'.format(baseURL,dcbBiaProductPath,yyyy,fname)
-			FetchFile(session,url,'{}/{}'.format(biasdir,fname),'gzip compressed')
-		elif biasFormat == 'DCB': # legacy stuff 
-			prevmm = mm - 1
-			prevyy = yy
-			if prevmm == 0:
-				prevmm = 12
-				prevyy = prevyy -1
-			fnames = CODEBiasFile(prevyy,prevmm)
-			for f in fnames:
-				url = '{}/{:04d}/{}'.format(cfg['bias:code'],yyyy,f)
-				FetchFile(session,url,'{}/{}'.format(biasdir,f),'compress\'d')
-				
-	# Miscellanea - broadcast ephemeris
-	if (args.ephemeris):
-		magicTag = 'gzip compressed'
-		if (rnxVersion == 2): # GPS only!
-			
-			brdcName = 'brdc'
-			if (args.statid):
-				brdcName = args.statid
-			fname = '{}{:03d}0.{:02d}n.Z'.format(brdcName,doy,yy)
-			if brdcName == 'brdc':
-				fname = '{}{:03d}0.{:02d}n.gz'.format(brdcName,doy,yy)
-				url = '{}/{}/{:04d}/brdc/{}'.format(baseURL,brdcPath,yyyy,fname)
-			else:  
-				url = '{}/{}/{:04d}/{:03d}/{:02d}n/{}'.format(baseURL,brdcPath,yyyy,doy,yy,fname)
-				magicTag = 'compress\'d'
-				
-			FetchFile(session,url,'{}/{}'.format(outputdir,fname),magicTag)
-		
-		elif (rnxVersion == 3):
-			if args.statid:
-				fname = '{}_R_{:04d}{:03d}0000_01D_{}N.rnx.gz'.format(stationID,yyyy,doy,gnss)
-				yy = yyyy-100*int(yyyy/100)
-				url = '{}/{}/{:04d}/{:03d}/{:02d}{}/{}'.format(baseURL,stationDataPath,yyyy,doy,yy,
-					GNSStoNavDirectory(gnss),fname)
-			else: # we want the IGS combined ephemeris
-				fname = 'BRDC00IGS_R_{:04d}{:03d}0000_01D_MN.rnx.gz'.format(yyyy,doy)
-				url = '{}/{}/{:04d}/brdc/{}'.format(baseURL,stationDataPath,yyyy,fname)
-			FetchFile(session,url,'{}/{}'.format(outputdir,fname),magicTag)
-	
-	# Miscellanea - station observations
-	if (args.observations):
-		magicTag = 'gzip compressed'
-		gnss = MIXED # FIXME maybe
-		if (rnxVersion == 2):
-			if (gnss == MIXED):
-				yy = yyyy-100*int(yyyy/100)
-				fname = '{}{:03d}0.{}o.Z'.format(stationID,doy,yy)
-				url = '{}/{}/{:04d}/{:03d}/{:02d}o/{}'.format(baseURL,stationDataPath,yyyy,doy,yy,fname)
-				FetchFile(session,url,'{}/{}'.format(outputdir,fname),magicTag)
-			else:
-				print('Warning: only mixed observation files are downloaded - skipping ...')
-		elif (rnxVersion == 3):
-			if (gnss == MIXED):
-				fname = '{}_R_{:04d}{:03d}0000_01D_30S_{}O.crx.gz'.format(stationID,yyyy,doy,gnss)
-				# MO in 'd'
-				yy = yyyy-100*int(yyyy/100)
-				url = '{}/{}/{:04d}/{:03d}/{:02d}d/{}'.format(baseURL,stationDataPath,yyyy,doy,yy,fname)
-				FetchFile(session,url,'{}/{}'.format(outputdir,fname),magicTag)
-			else:
-				print('Warning: only mixed observation files are downloaded - skipping ...')
+if len(stationIDs) > 1: # what's missing for each station
+	for st in stationIDs:
+		stationResults = [r for r in results if stationFiles.get(r[1]) == st]
+		absent = [r for r in stationResults if not(r[2] in [DOWNLOADED,SKIPPED,NOTMODIFIED])]
+		print('{}: {:d} of {:d} files{}'.format(st,len(stationResults) - len(absent),len(stationResults),
+			', missing ' + ' '.join([os.path.basename(r[1]) for r in absent]) if absent else ''))
 
 ottp.Debug('Downloads completed!')
 